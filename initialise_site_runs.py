@@ -16,6 +16,8 @@ __email__ = "mdekauwe@gmail.com"
 
 import os
 import sys
+import glob
+import shutil
 import datetime
 import subprocess
 from optparse import OptionParser
@@ -26,6 +28,12 @@ sys.path.append("scripts")
 from get_cable import GetCable
 from build_cable import BuildCable
 from generate_qsub_script import create_qsub_script
+from generate_qsub_script import size_array_job
+from campaign import catalog_tasks
+from campaign import partition_tasks
+from met_catalog import open_catalog
+from cable_utils import read_run_stats
+from cable_utils import get_secs_per_step
 
 
 # i.e. if on NCI
@@ -34,8 +42,34 @@ if ("Mac" not in nodename and
     "imac" not in nodename and
     "unsw" not in nodename):
 
+    # Job array, each element gets a slice of the campaign and resources to
+    # suit the met files in it. Timings from the last campaign if we have
+    # them
+    if nslices > 1:
+        if len(met_subset) == 0:
+            met_files = glob.glob(os.path.join(met_dir, "*.nc"))
+        else:
+            met_files = [os.path.join(met_dir, i) for i in met_subset]
+        open_catalog(os.path.join(run_dir, met_catalog_fname)).scan(met_files)
+        tasks = catalog_tasks(met_files, len(repos), sci_configs)
+        slices = partition_tasks(tasks, nslices)
+
+        stats_fname = os.path.join(run_dir, log_dir, "run_stats.jsonl")
+        measured = get_secs_per_step(read_run_stats(stats_fname))
+        if measured is not None:
+            secs_per_step = measured
+        (mem, wall_time) = size_array_job(slices, ncpus, secs_per_step)
+
+    # The qsub script resumes from the ledger, so if it hits walltime it can
+    # just be resubmitted. This is a new campaign, so clear any old ledger
     create_qsub_script(qsub_fname, ncpus, mem, wall_time, project,
-                       email_address)
+                       email_address, resume=True, jobfs=jobfs,
+                       nslices=nslices)
+    old_ledger = os.path.join(run_dir, ledger_fname)
+    if os.path.isfile(old_ledger):
+        os.remove(old_ledger)
+    shutil.rmtree(os.path.join(run_dir, queue_dir), ignore_errors=True)
+    shutil.rmtree(os.path.join(run_dir, restart_dir), ignore_errors=True)
 
 parser = OptionParser()
 parser.add_option("-s", "--skipbuild", action="store_true", default=False,
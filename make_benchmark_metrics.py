@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+"""
+Work out the bias, RMSE, correlation etc of the new repo's runs against the
+old for every site, science config and variable, and write them to one
+table (see scripts/benchmark_metrics.py)
+
+That's all folks.
+"""
+
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import sys
+
+from user_options import *
+
+sys.path.append("scripts")
+from benchmark_metrics import main as calc_metrics
+from output_index import index_outputs
+from output_index import pair_outputs
+
+if not os.path.exists(plot_dir):
+    os.makedirs(plot_dir)
+
+ofdir = os.path.join(run_dir, output_dir)
+(pairs, missing) = pair_outputs(index_outputs(ofdir))
+for (site, repo_id, sci_id) in missing:
+    print("No output for %s R%d S%d" % (site, repo_id, sci_id))
+pairs = [pair for pair in pairs if pair[1] < len(sci_configs)]
+
+df = calc_metrics(pairs, os.path.join(plot_dir, metrics_fname), mpi=mpi,
+                  num_cores=num_cores)
+
+# Worst first, so the runs worth looking at are at the top
+df = df.reindex(df.rmse.sort_values(ascending=False).index)
+print(df.head(20).to_string(index=False))
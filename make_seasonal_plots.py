@@ -14,14 +14,15 @@ __email__ = "mdekauwe@gmail.com"
 import os
 import shutil
 import sys
-import glob
 import datetime
 
-import numpy as np
 from user_options import *
 
 sys.path.append("scripts")
-from benchmark_seasonal_plot import main as seas_plot
+from benchmark_seasonal_plot import make_plots
+from reduction_cache import ReductionCache
+from output_index import index_outputs
+from output_index import pair_outputs
 
 #
 ## Make seasonal plots ...
@@ -29,17 +30,25 @@ from benchmark_seasonal_plot import main as seas_plot
 if not os.path.exists(plot_dir):
     os.makedirs(plot_dir)
 
+# Outputs are only reduced once, e.g. the trunk's for every branch
+if reduction_cache_dir is not None:
+    cache = ReductionCache(os.path.join(run_dir, reduction_cache_dir))
+else:
+    cache = None
+
 ofdir = os.path.join(run_dir, output_dir)
-all_files = glob.glob(os.path.join(ofdir, "*.nc"))
-sites = np.unique([os.path.basename(f).split(".")[0].split("_")[0] \
-                   for f in all_files])
-for site in sites:
-    print(site)
-    for sci_id, sci_config in enumerate(sci_configs):
-
-        old_fname = glob.glob("%s/%s_*_R%d_S%d_out.nc" % \
-                        (ofdir, site, 0, sci_id))[0]
-        new_fname = glob.glob("%s/%s_*_R%d_S%d_out.nc" % \
-                        (ofdir, site, 1, sci_id))[0]
-        plot_fname = os.path.join(plot_dir, "%s_S%d.png" % (site, sci_id))
-        seas_plot(old_fname, new_fname, plot_fname)
+(pairs, missing) = pair_outputs(index_outputs(ofdir))
+for (site, repo_id, sci_id) in missing:
+    print("No output for %s R%d S%d" % (site, repo_id, sci_id))
+
+jobs = []
+for (site, sci_id, old_fname, new_fname) in pairs:
+    if sci_id >= len(sci_configs):
+        continue
+    plot_fname = os.path.join(plot_dir, "%s_S%d.png" % (site, sci_id))
+    jobs.append((old_fname, new_fname, plot_fname))
+
+# Spread the sites x sci_configs grid over num_cores processes
+failed = make_plots(jobs, mpi=mpi, num_cores=num_cores, cache=cache)
+for plot_fname in failed:
+    print("Couldn't make %s" % (plot_fname))
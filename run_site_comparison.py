@@ -27,6 +27,16 @@ sys.path.append("scripts")
 from get_cable import GetCable
 from build_cable import BuildCable
 from run_cable_site import RunCable
+from campaign import plan_campaign
+from campaign import order_tasks
+from campaign import partition_tasks
+from campaign import run_campaign
+from campaign import render_namelists
+from campaign import clear_spin_ups
+from campaign import Ledger
+from async_campaign import run_campaign_async
+from work_queue import WorkQueue
+from met_catalog import open_catalog
 
 
 parser = OptionParser()
@@ -34,6 +44,12 @@ parser.add_option("--qsub", action="store_true", default=False,
                   help="Run qsub script?")
 parser.add_option("-s", "--skipsrc", action="store_true", default=False,
                   help="Rebuild src?")
+parser.add_option("-r", "--resume", action="store_true", default=False,
+                  help="Only run tasks not already finished in the ledger?")
+parser.add_option("--slice", type="int", default=0,
+                  help="Which slice of the campaign to run (job array index)")
+parser.add_option("--nslices", type="int", default=1,
+                  help="Number of slices the campaign is split into")
 
 (options, args) = parser.parse_args()
 
@@ -82,17 +98,62 @@ if not os.path.exists(run_dir):
     os.makedirs(run_dir)
 os.chdir(run_dir)
 
+# What's in each met file, so planning doesn't mean reading them all again
+open_catalog(met_catalog_fname)
+
 cable_aux = os.path.join("../", aux_dir)
+lai_cache_bytes = None
+if lai_cache_gb is not None:
+    lai_cache_bytes = lai_cache_gb * 1024**3
+runners = []
 for repo_id, repo in enumerate(repos):
     cable_src = os.path.join(os.path.join("../", src_dir), repo)
     R = RunCable(met_dir=met_dir, log_dir=log_dir,
                  output_dir=output_dir, restart_dir=restart_dir,
                  aux_dir=cable_aux, namelist_dir=namelist_dir,
-                 met_subset=met_subset, cable_src=cable_src, mpi=mpi,
-                 num_cores=num_cores)
-    for sci_id, sci_config in enumerate(sci_configs):
-        R.main(sci_config, repo_id, sci_id)
-
-
+                 met_subset=met_subset, cable_src=cable_src,
+                 local_exe="cable_R%d" % (repo_id), cache_dir=cache_dir,
+                 lai_cache_dir=lai_cache_dir, lai_cache_bytes=lai_cache_bytes,
+                 scratch_dir=scratch_dir, timeout_factor=timeout_factor,
+                 stall_time=stall_time, spin_up=spin_up,
+                 nyear_spinup=nyear_spinup, max_spin_cycles=max_spin_cycles,
+                 mpi=mpi, num_cores=num_cores)
+    runners.append(R)
+
+# All (repo, sci_config, site) runs go through a single pool, no barriers
+# between repos or science configs. Longest runs are dispatched first
+tasks = plan_campaign(runners, sci_configs)
+
+# As a PBS job array element, just our share of the campaign. The split is
+# made on the full campaign, so it is the same on every resubmission
+if options.nslices > 1:
+    tasks = partition_tasks(tasks, options.nslices)[options.slice]
+
+# Record each finished run so an interrupted campaign can pick up where it
+# left off, otherwise start the ledger afresh. Any number of jobs resuming
+# the same campaign share out the remaining tasks through the work queue
+L = Ledger(fname=ledger_fname)
+if options.resume:
+    tasks = L.pending(tasks)
+else:
+    L.reset()
+Q = WorkQueue(queue_dir=queue_dir, ledger=L)
+if not options.resume:
+    Q.reset()
+
+tasks = order_tasks(tasks)
+
+# The runs start from each site's spun up state, spun up by the task itself.
+# Spin-ups left by an interrupted campaign are only kept when resuming
+if spin_up and not options.resume:
+    clear_spin_ups(tasks)
+
+# Every namelist is written (and checked) before any model starts
+render_namelists(tasks)
+if mpi and engine == "asyncio":
+    run_campaign_async(tasks, num_cores=num_cores, ledger=L, work_queue=Q)
+else:
+    run_campaign(tasks, mpi=mpi, num_cores=num_cores, ledger=L,
+                 work_queue=Q)
 
 os.chdir(cwd)
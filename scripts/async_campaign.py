@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+asyncio engine for a site campaign, an alternative to campaign.run_campaign.
+
+Rather than a pool of forked Python workers, each blocking on one CABLE run,
+a single event loop launches the cable executables as asyncio subprocesses,
+at most num_cores at a time, and streams their stdout/stderr into a log file
+per run. The I/O bound steps either side of a run (writing the namelist,
+adding LAI, adding attributes to the output, copying back from scratch) are
+run in threads alongside the model runs. The netCDF4/HDF5 library isn't
+thread-safe, so only one thread at a time prepares or finishes a site;
+copying back from scratch is plain file I/O and isn't held up by this.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import time
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+from campaign import finish_task
+from run_cable_site import sample_proc_usage
+from run_cable_site import Watchdog
+
+def run_campaign_async(tasks, num_cores=None, ledger=None, work_queue=None,
+                       sample_every=1.0, renew_every=60.):
+    """
+    Run all the tasks, same as campaign.run_campaign.
+
+    Parameters:
+    ----------
+    tasks : list
+        list of Task tuples, dispatched in the order given
+    num_cores : int
+        maximum number of model runs at once
+    ledger : Ledger
+        optional record of each task's outcome
+    work_queue : WorkQueue
+        optional queue shared with other jobs
+    sample_every : float
+        how often (s) to sample the resources used by each run
+    renew_every : float
+        how often (s) to renew our work_queue claims
+    """
+    if len(tasks) == 0:
+        return
+    if num_cores is None: # use them all!
+        num_cores = os.cpu_count()
+
+    asyncio.run(drive(tasks, num_cores, ledger, work_queue, sample_every,
+                      renew_every))
+
+async def drive(tasks, num_cores, ledger, work_queue, sample_every,
+                renew_every):
+
+    loop = asyncio.get_running_loop()
+    threads = ThreadPoolExecutor(max_workers=num_cores)
+    spinners = ProcessPoolExecutor(max_workers=num_cores)
+
+    # Only num_cores runs at a time, and only num_cores more prepared and
+    # waiting, so we aren't sat on a namelist/LAI file for every task
+    running = asyncio.Semaphore(num_cores)
+    prepared = asyncio.Semaphore(num_cores)
+    netcdf_lock = threading.Lock()
+
+    def locked(func, *args):
+        with netcdf_lock:
+            return func(*args)
+
+    async def one(task):
+        R = task.runner
+        try:
+            async with prepared:
+                # Only claim a task once we are about to start on it
+                if work_queue is not None and not work_queue.claim(task):
+                    return
+
+                run = await loop.run_in_executor(threads, locked,
+                                                 R.prepare_site,
+                                                 task.met_fname, task.url,
+                                                 task.rev, task.sci_config,
+                                                 task.repo_id, task.sci_id,
+                                                 False)
+                if run is None:
+                    # Found in the run cache
+                    finish_task(task, "done", ledger, work_queue)
+                    return
+
+                # Spin up in a separate process, it is a string of model
+                # runs and netCDF reads
+                if R.spin_up:
+                    try:
+                        async with running:
+                            await loop.run_in_executor(spinners,
+                                                       R.ensure_spun_up,
+                                                       task.met_fname,
+                                                       task.sci_config,
+                                                       task.repo_id,
+                                                       task.sci_id)
+                    except Exception:
+                        R.discard_site(run)
+                        raise
+                await running.acquire()
+
+            try:
+                (error, usage) = await run_model(R, run, sample_every)
+            finally:
+                running.release()
+
+            (error, staged) = await loop.run_in_executor(threads, locked,
+                                                         R.finish_site, run,
+                                                         error, usage)
+            if staged is not None:
+                await loop.run_in_executor(threads, R.copy_back, staged)
+            status = "done" if error == 0 else "failed"
+        except Exception:
+            traceback.print_exc()
+            status = "failed"
+
+        finish_task(task, status, ledger, work_queue)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(renew_every)
+            work_queue.renew()
+
+    if work_queue is not None:
+        renewer = asyncio.ensure_future(heartbeat())
+    await asyncio.gather(*[one(task) for task in tasks])
+    if work_queue is not None:
+        renewer.cancel()
+    threads.shutdown(wait=True)
+    spinners.shutdown(wait=True)
+
+async def run_model(R, run, sample_every):
+    """
+    Run CABLE as an asyncio subprocess, with stdout and stderr going to the
+    run's own log file. As the event loop reaps the process, the resources
+    it used are sampled from /proc while it runs, so the CPU time/memory/IO
+    numbers are those from the last sample before it finished.
+
+    Hung runs are killed, same as RunCable.run_me.
+    """
+    cmd = [os.path.abspath(R.cable_exe), os.path.abspath(run["nml_fname"])]
+
+    start = time.time()
+    usage = {}
+    killed = None
+    watchdog = Watchdog(run["run_out_fname"], timeout=run["timeout"],
+                        stall_time=R.stall_time)
+    with open(run["stdout_fname"], "w") as f:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=f,
+                                                    stderr=asyncio.subprocess.STDOUT,
+                                                    cwd=run["work_dir"] or None)
+        while True:
+            try:
+                error = await asyncio.wait_for(proc.wait(), sample_every)
+                break
+            except asyncio.TimeoutError:
+                sample = sample_proc_usage(proc.pid)
+                if sample is not None:
+                    usage = sample
+                if killed is None:
+                    killed = watchdog.check()
+                    if killed is not None:
+                        proc.kill()
+
+    for key in ["user_time", "sys_time", "max_rss_kb", "rchar", "wchar",
+                "read_bytes", "write_bytes"]:
+        usage.setdefault(key, None)
+    usage["wall_time"] = time.time() - start
+    usage["killed"] = killed
+    if killed is not None:
+        print("Job killed: %s, %s" % (" ".join(cmd), killed))
+    elif error != 0:
+        print("Job failed: %s, exit code %d" % (" ".join(cmd), error))
+
+    return (error, usage)
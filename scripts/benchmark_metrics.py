@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+Quantitative benchmark of old vs new model runs: for each site, science
+config and variable, the bias, RMSE, correlation, normalised standard
+deviation and maximum absolute difference of the new run against the old,
+over every timestep, written to one table.
+
+Each pair of outputs is read a chunk of timesteps at a time and boiled
+down to sums (count, sums, sums of squares and products, maximum absolute
+difference), and the metrics for all the sites are then worked out
+together from the stacked sums.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import traceback
+import netCDF4
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+
+from reduction_cache import VARS
+from reduction_cache import get_unit_conversions
+
+# Sums kept for each variable, x is the old run and y the new, d = y - x
+STATS = ["n", "sx", "sy", "sxx", "syy", "sxy", "sdd", "maxd"]
+
+def main(pairs, metrics_fname, mpi=True, num_cores=None):
+    """
+    Parameters:
+    ----------
+    pairs : list
+        (site, sci_id, old_fname, new_fname) for each comparison
+    metrics_fname : string
+        CSV file to write the table to
+    mpi : bool
+        read several pairs at once? otherwise one after another
+    num_cores : int
+        number of worker processes, None uses all cores
+
+    Returns:
+    --------
+    df : dataframe
+        the table, one row per site, sci_id and variable
+    """
+    stats = accumulate_all(pairs, mpi=mpi, num_cores=num_cores)
+    metrics = calculate_metrics(stats)
+
+    rows = []
+    for i, (site, sci_id, old_fname, new_fname) in enumerate(pairs):
+        for j, v in enumerate(VARS):
+            row = {"site": site, "sci_id": sci_id, "variable": v,
+                   "n": int(stats[i,j,0])}
+            for metric, values in metrics.items():
+                row[metric] = values[i,j]
+            rows.append(row)
+
+    columns = ["site", "sci_id", "variable", "n"] + list(metrics.keys())
+    df = pd.DataFrame(rows, columns=columns)
+    df.to_csv(metrics_fname, index=False, float_format="%.6g")
+
+    return df
+
+def accumulate_all(pairs, mpi=True, num_cores=None):
+    """
+    Sums for every pair of outputs, a pair that can't be read is reported
+    and left with n = 0 (so NaN metrics).
+
+    Returns:
+    --------
+    stats : array
+        (number of pairs, number of VARS, number of STATS)
+    """
+    fnames = [(old_fname, new_fname) \
+                for (site, sci_id, old_fname, new_fname) in pairs]
+
+    if not mpi or len(fnames) <= 1:
+        results = [accumulate_job(job) for job in fnames]
+    else:
+        if num_cores is None: # use them all!
+            num_cores = mp.cpu_count()
+        num_cores = max(1, min(num_cores, len(fnames)))
+
+        pool = mp.Pool(processes=num_cores)
+        results = pool.map(accumulate_job, fnames)
+        pool.close()
+        pool.join()
+
+    stats = np.zeros((len(pairs), len(VARS), len(STATS)))
+    for i, result in enumerate(results):
+        if result is not None:
+            stats[i] = result
+
+    return stats
+
+def accumulate_job(job):
+    (old_fname, new_fname) = job
+    try:
+        return accumulate_pair(old_fname, new_fname)
+    except Exception:
+        traceback.print_exc()
+        return None
+
+def accumulate_pair(old_fname, new_fname, chunk_size=17520):
+    """
+    Sums for one pair of outputs, reading chunk_size timesteps of every
+    variable at a time. Only timesteps where both runs have valid data are
+    counted, and units are converted as in the plots.
+
+    Returns:
+    --------
+    stats : array
+        (number of VARS, number of STATS)
+    """
+    conversions = np.array([get_unit_conversions()[v] for v in VARS])
+
+    f_old = netCDF4.Dataset(old_fname)
+    f_new = netCDF4.Dataset(new_fname)
+    nsteps = len(f_old.variables["time"])
+    if len(f_new.variables["time"]) != nsteps:
+        raise ValueError("%s and %s have different numbers of timesteps" % \
+                         (old_fname, new_fname))
+
+    stats = np.zeros((len(VARS), len(STATS)))
+    for start in range(0, nsteps, chunk_size):
+        stop = min(start + chunk_size, nsteps)
+        if not np.array_equal(f_old.variables["time"][start:stop],
+                              f_new.variables["time"][start:stop]):
+            raise ValueError("%s and %s have different times" % \
+                             (old_fname, new_fname))
+
+        x = read_chunk(f_old, start, stop) * conversions[:,None]
+        y = read_chunk(f_new, start, stop) * conversions[:,None]
+        ok = np.isfinite(x) & np.isfinite(y)
+        x = np.where(ok, x, 0.0)
+        y = np.where(ok, y, 0.0)
+        d = y - x
+
+        stats[:,0] += ok.sum(axis=1)
+        stats[:,1] += x.sum(axis=1)
+        stats[:,2] += y.sum(axis=1)
+        stats[:,3] += (x * x).sum(axis=1)
+        stats[:,4] += (y * y).sum(axis=1)
+        stats[:,5] += (x * y).sum(axis=1)
+        stats[:,6] += (d * d).sum(axis=1)
+        stats[:,7] = np.maximum(stats[:,7], np.abs(d).max(axis=1))
+    f_old.close()
+    f_new.close()
+
+    return stats
+
+def read_chunk(f, start, stop):
+    """
+    Timesteps start to stop of every variable, (VARS, time) with NaN where
+    the output is missing.
+    """
+    data = np.empty((len(VARS), stop - start))
+    for j, v in enumerate(VARS):
+        values = f.variables[v][start:stop]
+        values = values.reshape(stop - start, -1)[:,0]
+        data[j] = np.ma.filled(values.astype(np.float64), np.nan)
+
+    return data
+
+def calculate_metrics(stats):
+    """
+    Metrics of the new runs against the old from the stacked sums, works on
+    any number of leading dimensions.
+
+    Returns:
+    --------
+    metrics : dictionary
+        bias (mean new - old), rmse, corr (Pearson), norm_sd (SD of new /
+        SD of old) and max_abs_diff, each shaped like stats[...,0]
+    """
+    (n, sx, sy, sxx, syy, sxy, sdd, maxd) = np.moveaxis(stats, -1, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = np.where(n > 0, n, np.nan)
+        mean_x = sx / n
+        mean_y = sy / n
+        var_x = np.maximum(sxx / n - mean_x**2, 0.0)
+        var_y = np.maximum(syy / n - mean_y**2, 0.0)
+        cov = sxy / n - mean_x * mean_y
+
+        metrics = {"bias": mean_y - mean_x,
+                   "rmse": np.sqrt(sdd / n),
+                   "corr": np.clip(cov / np.sqrt(var_x * var_y), -1.0, 1.0),
+                   "norm_sd": np.sqrt(var_y / var_x),
+                   "max_abs_diff": np.where(np.isfinite(n), maxd, np.nan)}
+
+    return metrics
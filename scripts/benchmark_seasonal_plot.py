@@ -9,33 +9,27 @@ __author__ = "Martin De Kauwe"
 __version__ = "1.0 (18.10.2017)"
 __email__ = "mdekauwe@gmail.com"
 
-import xarray as xr
+import matplotlib
+matplotlib.use("Agg") # only ever written to file
 import matplotlib.pyplot as plt
 import sys
-import datetime as dt
+import traceback
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
 from matplotlib.ticker import FixedLocator
 
-def main(old_fname, new_fname, plot_fname):
+from reduction_cache import VARS
+from reduction_cache import reduce_output
 
-    df_old = read_cable_file(old_fname)
-    df_old = resample_to_seasonal_cycle(df_old)
+def main(old_fname, new_fname, plot_fname, cache=None):
 
-    df_new = read_cable_file(new_fname)
-    df_new = resample_to_seasonal_cycle(df_new)
+    df_old = read_seasonal_cycle(old_fname, cache)
+    df_new = read_seasonal_cycle(new_fname, cache)
 
     fig = plt.figure(figsize=(6,9))
     fig.subplots_adjust(hspace=0.3)
     fig.subplots_adjust(wspace=0.2)
-    plt.rcParams['text.usetex'] = False
-    plt.rcParams['font.family'] = "sans-serif"
-    plt.rcParams['font.sans-serif'] = "Helvetica"
-    plt.rcParams['axes.labelsize'] = 12
-    plt.rcParams['font.size'] = 12
-    plt.rcParams['legend.fontsize'] = 12
-    plt.rcParams['xtick.labelsize'] = 12
-    plt.rcParams['ytick.labelsize'] = 12
 
     ax1 = fig.add_subplot(3,2,1)
     ax2 = fig.add_subplot(3,2,2)
@@ -45,8 +39,7 @@ def main(old_fname, new_fname, plot_fname):
     ax6 = fig.add_subplot(3,2,6)
 
     axes = [ax1, ax2, ax3, ax4, ax5, ax6]
-    vars = ["GPP", "NEE", "Qle", "Qh", "TVeg", "ESoil"]
-    for a, v in zip(axes, vars):
+    for a, v in zip(axes, VARS):
         a.plot(df_old.month, df_old[v], c="black", lw=2.0, ls="-", label="Old")
         a.plot(df_new.month, df_new[v], c="red", lw=2.0, ls="-", label="New")
 
@@ -68,45 +61,109 @@ def main(old_fname, new_fname, plot_fname):
 
     ax1.legend(loc="best", numpoints=1)
     fig.savefig(plot_fname, bbox_inches='tight', pad_inches=0.1)
+    plt.close(fig)
 
-def read_cable_file(fname):
-    # works with new cftime update
-    ds = xr.open_dataset(fname, decode_times=True)
-    vars_to_keep = ['GPP','Qle','Qh','TVeg','ESoil','NEE','time']
-    df = ds[vars_to_keep].squeeze(dim=["x","y"], drop=True).to_dataframe()
-
-    #f = nc.Dataset(fname)
-    #time = nc.num2date(f.variables['time'][:],
-    #                    f.variables['time'].units)
-    #df = pd.DataFrame(f.variables['GPP'][:,0,0], columns=['GPP'])
-    #df['Qle'] = f.variables['Qle'][:,0,0]
-    #df['Qh'] = f.variables['Qh'][:,0,0]
-    #df['TVeg'] = f.variables['TVeg'][:,0,0]
-    #df['ESoil'] = f.variables['ESoil'][:,0,0]
-    #df['NEE'] = f.variables['NEE'][:,0,0]
-    #
-    #df['dates'] = time
-    #df = df.set_index('dates')
-
-    return df
-
-def resample_to_seasonal_cycle(df, OBS=False):
-
-    UMOL_TO_MOL = 1E-6
-    MOL_C_TO_GRAMS_C = 12.0
-    SEC_2_DAY = 86400.
-
-    # umol/m2/s -> g/C/d
-    df['GPP'] *= UMOL_TO_MOL * MOL_C_TO_GRAMS_C * SEC_2_DAY
-    df['NEE'] *= UMOL_TO_MOL * MOL_C_TO_GRAMS_C * SEC_2_DAY
-
-    # kg/m2/s -> mm/d
-    df['TVeg'] *= SEC_2_DAY
-    df['ESoil'] *= SEC_2_DAY
+def set_plot_style():
+    plt.rcParams['text.usetex'] = False
+    plt.rcParams['font.family'] = "sans-serif"
+    plt.rcParams['font.sans-serif'] = "Helvetica"
+    plt.rcParams['axes.labelsize'] = 12
+    plt.rcParams['font.size'] = 12
+    plt.rcParams['legend.fontsize'] = 12
+    plt.rcParams['xtick.labelsize'] = 12
+    plt.rcParams['ytick.labelsize'] = 12
 
-    method = {'GPP':'mean', 'NEE':'mean', 'Qle':'mean', 'Qh':'mean',
-              'TVeg':'mean', 'ESoil':'mean'}
-    df = df.resample("M").agg(method).groupby(lambda x: x.month).mean()
+def make_plots(jobs, mpi=True, num_cores=None, cache=None):
+    """
+    Make many plots, spread over num_cores worker processes. Each worker
+    sets the plot style once and closes every figure it makes.
+
+    Parameters:
+    ----------
+    jobs : list
+        (old_fname, new_fname, plot_fname) for each plot
+    mpi : bool
+        use several processes? otherwise plot one after another
+    num_cores : int
+        number of worker processes, None uses all cores
+    cache : object
+        ReductionCache shared by the workers, or None
+
+    Returns:
+    --------
+    failed : list
+        plot filenames that couldn't be made
+    """
+    jobs = [(old_fname, new_fname, plot_fname, cache) \
+                for (old_fname, new_fname, plot_fname) in jobs]
+
+    if not mpi or len(jobs) <= 1:
+        set_plot_style()
+        results = [plot_job(job) for job in jobs]
+    else:
+        if num_cores is None: # use them all!
+            num_cores = mp.cpu_count()
+        num_cores = max(1, min(num_cores, len(jobs)))
+
+        pool = mp.Pool(processes=num_cores, initializer=set_plot_style)
+        results = list(pool.imap_unordered(plot_job, jobs))
+        pool.close()
+        pool.join()
+
+    # Workers each have their own copy of the cache, so make sure the index
+    # ends up with every hash they added
+    if cache is not None:
+        for (plot_fname, ok, hashes) in results:
+            cache.changed.update(hashes)
+        cache.save()
+
+    return [plot_fname for (plot_fname, ok, hashes) in results if not ok]
+
+def plot_job(job):
+    """
+    Make a single plot, a broken output is reported and the rest of the
+    plots carry on. Returns the plot filename, whether it was made and the
+    hashes the job added to the cache.
+    """
+    (old_fname, new_fname, plot_fname, cache) = job
+    ok = True
+    try:
+        main(old_fname, new_fname, plot_fname, cache)
+        print(plot_fname)
+    except Exception:
+        traceback.print_exc()
+        plt.close("all")
+        ok = False
+    hashes = cache.changed if cache is not None else {}
+
+    return (plot_fname, ok, hashes)
+
+def read_seasonal_cycle(fname, cache=None):
+    """
+    Average seasonal cycle of an output file, i.e. the mean over years of
+    each calendar month's monthly mean (see reduction_cache.reduce_output).
+
+    Parameters:
+    ----------
+    fname : string
+        CABLE output filename
+    cache : object
+        ReductionCache to look the reduction up in, None to always read
+        the output
+
+    Returns:
+    --------
+    df : dataframe
+        one row per calendar month, with a month column (1-12)
+    """
+    if cache is not None:
+        products = cache.get(fname)
+    else:
+        products = reduce_output(fname)
+
+    df = pd.DataFrame()
+    for v in VARS:
+        df[v] = products["%s_seasonal" % (v)]
     df['month'] = np.arange(1,13)
 
     return df
@@ -124,4 +181,5 @@ if __name__ == "__main__":
                       help="Benchmark plot filename", type="string")
     (options, args) = parser.parse_args()
 
+    set_plot_style()
     main(options.old_fname, options.new_fname, options.plot_fname)
@@ -11,15 +11,22 @@ __email__ = "mdekauwe@gmail.com"
 
 
 import os
+import re
 import sys
+import json
+import fcntl
+import hashlib
 import netCDF4
 import shutil
-import tempfile
+import subprocess
 import pandas as pd
-import xarray as xr
 import numpy as np
 import matplotlib.pyplot as plt
 
+from namelist import Namelist
+from met_catalog import met_info
+from met_catalog import get_catalog
+
 def adjust_nml_file(fname, replacements):
     """
     Adjust the params/flags in the CABLE namelise file. Note this writes
@@ -30,15 +37,9 @@ def adjust_nml_file(fname, replacements):
     replacements : dictionary
         dictionary of replacement values.
     """
-    f = open(fname, 'r')
-    param_str = f.read()
-    f.close()
-    new_str = replace_keys(param_str, replacements)
-    fd, path = tempfile.mkstemp()
-    os.write(fd, str.encode(new_str))
-    os.close(fd)
-    shutil.copy(path, fname)
-    os.remove(path)
+    nml = Namelist(fname)
+    nml.update(replacements)
+    nml.write(fname)
 
 def replace_keys(text, replacements_dict):
     """ Function expects to find CABLE namelist file formatted key = value.
@@ -55,57 +56,21 @@ def replace_keys(text, replacements_dict):
     new_text : string
         input file with replacement values
     """
-    keys = [] # save our keys
-    lines = text.splitlines()
-    for i, row in enumerate(lines):
-        # skip blank lines
-        if not row.strip():
-            continue
-        elif "=" not in row:
-            lines[i] = row
-            continue
-        elif not row.startswith("&"):
-            key = row.split("=")[0]
-            val = row.split("=")[1]
-            lines[i] = " ".join((key.rstrip(), "=",
-                                 replacements_dict.get(key.strip(),
-                                 val.lstrip())))
-            keys.append(key.strip())
-
-    # Make sure our replacements were in the namelist to begin with, it is
-    # possible they were missing completely so we will need to add these
-    # manually
-    fix_end_statement = False
-    for key, val in replacements_dict.items():
-        if key not in keys:
-            key_to_add = " ".join((key.rstrip(), "=", val.strip()))
-            # add 3 extra spaces at the front to line things up
-            string_length = len(key_to_add) + 3
-            key_to_add = key_to_add.rjust(string_length)
-            lines[i] = key_to_add
-            fix_end_statement = True
-
-            # Need to add an extra element and sort out counter
-            lines.append("")
-            i += 1
-
-    if fix_end_statement:
-        lines[i] = "&end"
-
-    return '\n'.join(lines) + '\n'
+    nml = Namelist(text=text)
+    nml.update(replacements_dict)
+
+    return nml.render()
 
 def get_svn_info(here, there):
     """
     Add SVN info and cable namelist file to the output file
     """
 
+    # Read svn's output directly rather than via a temp file, as several jobs
+    # may be doing this at once
     os.chdir(there)
-    os.system("svn info > tmp_svn")
-    fname = 'tmp_svn'
-    fp = open(fname, "r")
-    svn = fp.readlines()
-    fp.close()
-    os.remove(fname)
+    p = subprocess.Popen("svn info", shell=True, stdout=subprocess.PIPE)
+    svn = p.communicate()[0].decode().splitlines()
 
     url = [i.split(":", 1)[1].strip() \
             for i in svn if i.startswith('URL')]
@@ -117,39 +82,111 @@ def get_svn_info(here, there):
 
 
 def add_attributes_to_output_file(nml_fname, fname, sci_config, url, rev):
+    """
+    Add the run's provenance (SVN info, science config and namelist) to the
+    output file. Everything is gathered first and written in a single
+    header update, each re-definition of a classic format file can mean
+    rewriting the whole file. The lot also goes in one JSON "provenance"
+    attribute, which is easier to read back than the individual ones.
+    """
+    # SVN info
+    attrs = {"cable_branch": url, "svn_revision_number": rev}
 
-    # Add SVN info to output file
-    nc = netCDF4.Dataset(fname, 'r+')
-    nc.setncattr('cable_branch', url)
-    nc.setncattr('svn_revision_number', rev)
-
-    for key, val in sci_config.items():
-        config_name = "%s_%s" % (key, val)
-        nc.setncattr('SCI_CONFIG', config_name)
+    # One attribute for the whole config, key_value pairs separated by ";"
+    attrs["SCI_CONFIG"] = "; ".join(["%s_%s" % (key, val) \
+                                     for key, val in sci_config.items()])
 
     # Add namelist to output file
-    fp = open(nml_fname, "r")
-    namelist = fp.readlines()
-    fp.close()
-
-    for i, row in enumerate(namelist):
-
-        # skip blank lines
-        if not row.strip():
-            continue
-        # Lines without key = value statement
-        elif "=" not in row:
-            continue
-        # Skip lines that are just comments as these can have "=" too
-        elif row.strip().startswith("!"):
-            continue
-        elif not row.startswith("&"):
-            key = str(row.strip().split("=")[0]).rstrip()
-            val = str(row.strip().split("=")[1]).rstrip()
-            nc.setncattr(key, val)
+    nml = Namelist(nml_fname)
+    namelist = {}
+    for key in nml.keys():
+        namelist[key] = nml.get(key)
+    attrs.update(namelist)
+
+    attrs["provenance"] = json.dumps({"cable_branch": url,
+                                      "svn_revision_number": rev,
+                                      "sci_config": sci_config,
+                                      "namelist": namelist}, sort_keys=True)
 
+    nc = netCDF4.Dataset(fname, 'r+')
+    nc.setncatts(attrs)
     nc.close()
 
+_file_hashes = {}
+
+def file_hash(fname, blocksize=2**20):
+    """
+    sha256 of a file's contents. Hashes are remembered per (path, size,
+    mtime), so a met file shared by many runs is only read once per process,
+    and met files' hashes are kept in the met catalog between campaigns.
+    """
+    st = os.stat(fname)
+    memo_key = (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        catalog = get_catalog()
+        digest = catalog.get_hash(fname)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(fname, "rb") as f:
+                for block in iter(lambda: f.read(blocksize), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            catalog.set_hash(fname, digest)
+        _file_hashes[memo_key] = digest
+
+    return _file_hashes[memo_key]
+
+def write_run_stats(fname, record):
+    """
+    Append a single run record to a JSON lines file. Each record is one short
+    line written in a single call, so concurrent workers can safely append to
+    the same file.
+    """
+    with open(fname, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+def read_run_stats(fname):
+    """
+    Read back the records from write_run_stats, skipping any partial lines
+    left by an interrupted run.
+    """
+    records = []
+    if not os.path.isfile(fname):
+        return records
+
+    with open(fname, "r") as f:
+        for row in f:
+            try:
+                records.append(json.loads(row))
+            except ValueError:
+                continue
+
+    return records
+
+def get_secs_per_step(records):
+    """
+    Average model seconds per met timestep over the successful runs in a
+    list of run records (see write_run_stats), None if there aren't any.
+    """
+    total_time = 0.0
+    total_steps = 0
+    for r in records:
+        if run_succeeded(r):
+            total_time += r["wall_time"]
+            total_steps += r["nsteps"]
+
+    if total_time > 0.0 and total_steps > 0:
+        return total_time / total_steps
+
+    return None
+
+def run_succeeded(record):
+    """
+    Did the run behind a run record finish properly, i.e. not fail or get
+    killed? Only these say how long a run really takes.
+    """
+    return record.get("exit_code", 0) == 0 and not record.get("killed")
+
 def ncdump(nc_fid):
     '''
     ncdump outputs dimensions, variables and their attribute information.
@@ -178,69 +215,186 @@ def ncdump(nc_fid):
 
     return nc_attrs, nc_dims, nc_vars
 
-def change_LAI(met_fname, site, fixed=None, lai_dir=None):
+def change_LAI(met_fname, site, fixed=None, lai_dir=None, new_met_fname=None):
+    """
+    Write a copy of the met file with an LAI variable added. The LAI is
+    either a fixed value, or the site's daily LAI climatology
+    (lai_dir/<site>_lai.csv, 365 values) mapped onto each timestep by its
+    day of year. The 31st December of a leap year gets the last value
+    again.
 
-    new_met_fname = "%s_tmp.nc" % (site)
+    Parameters:
+    ----------
+    met_fname : string
+        met forcing file
+    site : string
+        site name, used to find the LAI file
+    fixed : float
+        fixed LAI value, used instead of the climatology
+    lai_dir : string
+        directory with the LAI climatologies
+    new_met_fname : string
+        file to write, defaults to <site>_tmp.nc
 
+    Returns:
+    --------
+    new_met_fname : string
+        file written
+    """
+    if new_met_fname is None:
+        new_met_fname = "%s_tmp.nc" % (site)
+
+    clone_file(met_fname, new_met_fname)
+
+    nc = netCDF4.Dataset(new_met_fname, 'r+')
     if fixed is not None:
         lai = fixed
     else:
         lai_fname = os.path.join(lai_dir, "%s_lai.csv" % (site))
-        df_lai = pd.read_csv(lai_fname)
+        lai_clim = pd.read_csv(lai_fname)["LAI"].values
 
-        if lai_dir is not None:
-            ds = xr.open_dataset(met_fname)
+        doy = get_day_of_year(nc.variables['time'])
+        lai = lai_clim[np.minimum(doy, len(lai_clim) - 1)]
 
-            vars_to_keep = ['Tair']
-            dfx = ds[vars_to_keep].squeeze(dim=["x","y","z"],
-                                          drop=True).to_dataframe()
+    nc_var = nc.createVariable('LAI', 'f4', ('time', 'y', 'x'))
+    nc_var.setncatts({'long_name': u"Leaf Area Index",})
+    nc_var[:,0,0] = lai
+    nc.close()  # close the new file
 
-            out_length = len(dfx.Tair)
-            time_idx = dfx.index
-            dfx = dfx.reindex(time_idx)
-            dfx['year'] = dfx.index.year
-            dfx['doy'] = dfx.index.dayofyear
+    return new_met_fname
 
-            df_lai_out = pd.DataFrame(columns=['LAI'], index=range(out_length))
+def clone_file(src, dst):
+    """
+    Copy src to dst as a reflink (copy-on-write clone) where the filesystem
+    supports it (XFS, btrfs, ...), so the copy shares src's data blocks and
+    costs next to nothing until it is written to. Anywhere else it is an
+    ordinary copy.
+    """
+    FICLONE = 0x40049409 # from linux/fs.h
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copymode(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def get_day_of_year(time_var):
+    """
+    Zero-based day of year of each value of a CF time variable, i.e. 0 for
+    1st January, 365 for 31st December in a leap year.
+    """
+    dates = get_dates(time_var, time_var[:])
+    if dates.dtype == object:
+        return np.array([d.timetuple().tm_yday - 1 for d in dates])
 
-            df_non_leap = df_lai.copy()
-            df_leap = df_lai.copy()
-            extra = pd.DataFrame(columns=["LAI"], index=range(1))
-            extra.LAI[0] = df_lai.LAI[364]
-            df_leap = df_leap.append(extra)
-            df_leap = df_leap.reset_index(drop=True)
+    doy = dates.astype("datetime64[D]") - dates.astype("datetime64[Y]")
 
+    return doy.astype(int)
 
-            idx = 0
-            for yr in np.unique(dfx.index.year):
-                #print(yr)
-                ndays = int(len(dfx[dfx.index.year == yr]) / 48)
+def get_month_index(time_var, times):
+    """
+    Months since year 0 (year * 12 + month - 1) of some values of a CF time
+    variable, so consecutive months get consecutive numbers.
+    """
+    dates = get_dates(time_var, times)
+    if dates.dtype == object:
+        return np.array([d.year * 12 + d.month - 1 for d in dates])
 
-                if ndays == 366:
-                    st = idx
-                    en = idx + (366 * 48)
-                    df_lai_out.LAI[st:en] = np.repeat(df_leap.values, 48)
-                else:
-                    st = idx
-                    en = idx + (365 * 48)
-                    df_lai_out.LAI[st:en] = np.repeat(df_non_leap.values, 48)
+    months = dates.astype("datetime64[M]").astype(int)
 
-                idx += (ndays * 48)
+    # numpy counts months from 1970
+    return months + 1970 * 12
 
-    shutil.copyfile(met_fname, new_met_fname)
+def get_seconds_of_day(time_var, times):
+    """
+    Seconds since midnight of some values of a CF time variable.
+    """
+    dates = get_dates(time_var, times)
+    if dates.dtype == object:
+        return np.array([d.hour * 3600 + d.minute * 60 + d.second \
+                            for d in dates])
 
-    nc = netCDF4.Dataset(new_met_fname, 'r+')
-    (nc_attrs, nc_dims, nc_vars) = ncdump(nc)
+    secs = dates - dates.astype("datetime64[D]")
 
-    nc_var = nc.createVariable('LAI', 'f4', ('time', 'y', 'x'))
-    nc.setncatts({'long_name': u"Leaf Area Index",})
-    if lai_dir is not None:
-        nc.variables['LAI'][:,0,0] = df_lai_out.LAI.values.reshape(out_length, 1, 1)
-    else:
-        nc.variables['LAI'][:,0,0] = lai
-    nc.close()  # close the new file
+    return secs.astype("timedelta64[s]").astype(int)
 
-    return new_met_fname
+def get_dates(time_var, times):
+    """
+    Decode values of a CF time variable. Standard calendars with the usual
+    units are done with numpy datetimes straight from the units, anything
+    else goes through netCDF4.num2date and comes back as an object array of
+    cftime dates.
+    """
+    calendar = getattr(time_var, "calendar", "standard").lower()
+    ref = None
+    if calendar in ["standard", "gregorian", "proleptic_gregorian"]:
+        (unit, ref) = parse_time_units(time_var.units)
+    if ref is None:
+        return np.asarray(netCDF4.num2date(times, time_var.units,
+                                           calendar=calendar))
+
+    scale = unit * 10**9
+
+    return ref + (np.asarray(times, dtype=np.float64) *
+                  scale).astype("timedelta64[ns]")
+
+# YYYY-MM-DD[ hh:mm[:ss[.s]]][ tz], tz being Z, UTC or an offset (+10:00)
+REF_TIME = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})"
+                      r"(?:[ T](\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?)?"
+                      r"\s*(Z|UTC|[+-]\d{1,2}(?::?\d{2})?)?$", re.IGNORECASE)
+
+def parse_time_units(units):
+    """
+    Split CF time units, e.g. "seconds since 2002-01-01 00:00:00", into the
+    unit in seconds and the reference time as a UTC numpy datetime. Returns
+    (None, None) for anything we'd rather leave to netCDF4.num2date, which
+    is any reference time not written out in full as in REF_TIME.
+    """
+    secs = {"seconds": 1, "second": 1, "secs": 1, "sec": 1, "s": 1,
+            "minutes": 60, "minute": 60, "mins": 60, "min": 60,
+            "hours": 3600, "hour": 3600, "hrs": 3600, "hr": 3600, "h": 3600,
+            "days": 86400, "day": 86400, "d": 86400}
+
+    parts = units.split(" since ")
+    if len(parts) != 2 or parts[0].strip().lower() not in secs:
+        return (None, None)
+
+    match = REF_TIME.match(parts[1].strip())
+    if match is None:
+        return (None, None)
+    (year, month, day, hour, minute, second, tz) = match.groups()
+
+    # Before 1582 "standard" means the Julian calendar
+    if int(year) < 1583:
+        return (None, None)
+
+    try:
+        ref = np.datetime64("%s-%02d-%02dT%02d:%02d" % \
+                            (year, int(month), int(day), int(hour or 0),
+                             int(minute or 0)), "ns")
+    except ValueError:
+        return (None, None)
+    if second is not None:
+        ref += np.timedelta64(int(round(float(second) * 10**9)), "ns")
+
+    # Offsets are from UTC, e.g. local time in Canberra is +10:00
+    if tz is not None and tz.upper() not in ["Z", "UTC"]:
+        offset = tz[1:].replace(":", "")
+        if len(offset) > 2:
+            mins = int(offset[:-2]) * 60 + int(offset[-2:])
+        else:
+            mins = int(offset) * 60
+        if tz[0] == "-":
+            mins = -mins
+        ref -= np.timedelta64(mins, "m")
+
+    return (secs[parts[0].strip().lower()], ref)
+
+def get_nsteps(met_fname):
+    """
+    Number of timesteps in the met file, from the met catalog.
+    """
+    return met_info(met_fname)["nsteps"]
 
 def get_years(met_fname, nyear_spinup):
     """
@@ -250,16 +404,23 @@ def get_years(met_fname, nyear_spinup):
     """
     pre_indust = 1850
 
-    ds = xr.open_dataset(met_fname)
+    info = met_info(met_fname)
 
-    st_yr = pd.to_datetime(ds.time[0].values).year
+    st_yr = info["st_yr"]
 
     # PALS met files final year tag only has a single 30 min, so need to
-    # end at the previous year, which is the real file end
-    en_yr = pd.to_datetime(ds.time[-1].values).year - 1
+    # end at the previous year, which is the real file end. Files that stop
+    # at 31 Dec 23:30 (e.g. PLUMBER2) already end on their last year
+    en_yr = info["en_yr"]
+    if info["end"].replace(" ", "T").split("-", 1)[1][:11] == "01-01T00:00":
+        en_yr -= 1
 
     # length of met record
     nrec = en_yr - st_yr + 1
+    if nrec <= 0:
+        raise ValueError("Met record too short to spin up from: %s "
+                         "(%s to %s)" % (met_fname, info["start"],
+                                         info["end"]))
 
     # number of times met data is recycled during transient simulation
     nloop_transient = np.ceil((st_yr - 1 - pre_indust) / nrec) - 1
@@ -282,9 +443,12 @@ def check_steady_state(experiment_id, output_dir, num, debug=True):
     (fast, slow and active) carbon pools have reached equilibrium. To do
     this we are checking the state of the last year in the previous spin
     cycle to the state in the final year of the current spin cycle.
+
+    Only the last timestep of each file is read, and the totals are
+    remembered (see get_pool_totals), so the previous cycle's file isn't
+    read again.
     """
     tol = 0.05 # This is quite high, I use 0.005 in GDAY
-    g_2_kg = 0.001
 
     if num == 1:
         prev_cplant = 99999.9
@@ -292,15 +456,11 @@ def check_steady_state(experiment_id, output_dir, num, debug=True):
     else:
         fname = "%s_out_CASA_ccp%d.nc" % (experiment_id, num-1)
         fname = os.path.join(output_dir, fname)
-        ds = xr.open_dataset(fname)
-        prev_cplant = ds.cplant[:,:,0].values[-1].sum() * g_2_kg
-        prev_csoil = ds.csoil[:,:,0].values[-1].sum() * g_2_kg
+        (prev_cplant, prev_csoil) = get_pool_totals(fname)
 
     fname = "%s_out_CASA_ccp%d.nc" % (experiment_id, num)
     fname = os.path.join(output_dir, fname)
-    ds = xr.open_dataset(fname)
-    new_cplant = ds.cplant[:,:,0].values[-1].sum() * g_2_kg
-    new_csoil = ds.csoil[:,:,0].values[-1].sum() * g_2_kg
+    (new_cplant, new_csoil) = get_pool_totals(fname)
 
     if ( np.fabs(prev_cplant - new_cplant) < tol and
          np.fabs(prev_csoil - new_csoil) < tol ):
@@ -314,3 +474,25 @@ def check_steady_state(experiment_id, output_dir, num, debug=True):
               "*csoil", np.fabs(prev_csoil - new_csoil))
 
     return not_in_equilibrium
+
+_pool_totals = {}
+
+def get_pool_totals(fname):
+    """
+    Total plant and soil carbon (kg) at the last timestep of a CASA output
+    file. Only that time slice is read from disk, and the totals are
+    remembered per (path, size, mtime), so a spin-up cycle's file is only
+    read once however many checks use it.
+    """
+    g_2_kg = 0.001
+
+    st = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+    if key not in _pool_totals:
+        nc = netCDF4.Dataset(fname, 'r')
+        cplant = nc.variables['cplant'][-1,:,0].sum() * g_2_kg
+        csoil = nc.variables['csoil'][-1,:,0].sum() * g_2_kg
+        nc.close()
+        _pool_totals[key] = (float(cplant), float(csoil))
+
+    return _pool_totals[key]
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+"""
+Plan and run a site campaign, i.e. every (repo, science config, site)
+combination, as a single flat list of tasks shared by one pool of workers.
+
+There are no barriers between repos or science configs, so all the cores stay
+busy from the first site of the first config to the last site of the last.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import json
+import time
+import traceback
+import queue
+import threading
+import multiprocessing as mp
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cable_utils import get_nsteps
+from cable_utils import read_run_stats
+from cable_utils import get_secs_per_step
+from cable_utils import run_succeeded
+from met_catalog import get_catalog
+
+# One CABLE run; runner is the RunCable object for the task's repo
+Task = namedtuple("Task", ["runner", "met_fname", "url", "rev", "sci_config",
+                           "repo_id", "sci_id"])
+
+
+def plan_campaign(runners, sci_configs):
+    """
+    Expand the full (repo, science config, site) product into a task list.
+
+    Parameters:
+    ----------
+    runners : list
+        RunCable objects, one per repo, ordered by repo_id.
+    sci_configs : list
+        science config dictionaries, ordered by sci_id.
+
+    Returns:
+    --------
+    tasks : list
+        list of Task tuples
+    """
+    tasks = []
+    for repo_id, R in enumerate(runners):
+        (met_files, url, rev) = R.initialise_stuff()
+        get_catalog().scan(met_files)
+        for sci_id, sci_config in enumerate(sci_configs):
+            for fname in met_files:
+                tasks.append(Task(R, fname, url, rev, sci_config, repo_id,
+                                  sci_id))
+
+    return tasks
+
+def catalog_tasks(met_files, nrepos, sci_configs):
+    """
+    Same task list as plan_campaign, but straight from the met catalog with
+    no RunCable objects (runner, url and rev are None), for sizing and
+    splitting up a campaign before anything has been built.
+    """
+    tasks = []
+    for repo_id in range(nrepos):
+        for sci_id, sci_config in enumerate(sci_configs):
+            for fname in met_files:
+                tasks.append(Task(None, fname, None, None, sci_config,
+                                  repo_id, sci_id))
+
+    return tasks
+
+def partition_tasks(tasks, nslices):
+    """
+    Split the tasks into nslices slices of about the same total cost, one
+    per PBS job array element. Greedy longest-first: each task, largest
+    first, goes to the slice with the least work so far.
+
+    The cost is just the number of timesteps in the met file, not the run
+    history used by order_tasks, as every array element has to come up with
+    the same split however much has been run in the meantime.
+
+    Parameters:
+    ----------
+    tasks : list
+        list of Task tuples
+    nslices : int
+        number of slices
+
+    Returns:
+    --------
+    slices : list
+        nslices lists of Task tuples
+    """
+    nsteps = {}
+    for fname in set(task.met_fname for task in tasks):
+        nsteps[fname] = get_nsteps(fname)
+
+    # Ties broken on the task itself, so the order glob returns the met
+    # files in doesn't matter
+    tasks = sorted(tasks, key=lambda task: (-nsteps[task.met_fname],
+                                            task_site(task), task.repo_id,
+                                            task.sci_id))
+    slices = [[] for i in range(nslices)]
+    load = [0] * nslices
+    for task in tasks:
+        i = load.index(min(load))
+        slices[i].append(task)
+        load[i] += nsteps[task.met_fname]
+
+    return slices
+
+def order_tasks(tasks):
+    """
+    Longest-processing-time-first ordering of the tasks, so the longest
+    sites start first rather than stretching the tail of the campaign.
+
+    The expected cost of a task is its measured wall time from a previous
+    campaign if it ran successfully. Otherwise it is the number of
+    timesteps in the met file, scaled by the average seconds per timestep
+    of past runs, or left in timesteps if nothing has been measured yet.
+    """
+    history = {}
+    records = []
+    for fname in set(task.runner.stats_fname for task in tasks):
+        records.extend(read_run_stats(fname))
+    for r in records:
+        # A run that failed or was killed early says nothing about how long
+        # the site takes, and would send it to the back when it is rerun
+        if run_succeeded(r):
+            key = (r["site"], r["repo_id"], r["sci_id"])
+            history[key] = r["wall_time"]
+
+    # No successful runs means no history either, so all costs are then
+    # in timesteps
+    secs_per_step = get_secs_per_step(records)
+    if secs_per_step is None:
+        secs_per_step = 1.0
+
+    nsteps = {}
+    for fname in set(task.met_fname for task in tasks):
+        nsteps[fname] = get_nsteps(fname)
+
+    def cost(task):
+        key = (task_site(task), task.repo_id, task.sci_id)
+        if key in history:
+            return history[key]
+        return nsteps[task.met_fname] * secs_per_step
+
+    return sorted(tasks, key=cost, reverse=True)
+
+def render_namelists(tasks):
+    """
+    Write the namelist of every task into namelist_dir in one go, before any
+    model starts, so the workers only have to launch the executables. Keys
+    that aren't in the base namelist (e.g. a typo in a science config) are
+    reported up front, rather than by CABLE failing run after run.
+    """
+    unknown = set()
+    for task in tasks:
+        unknown.update(task.runner.write_namelist(task.met_fname,
+                                                  task.sci_config,
+                                                  task.repo_id, task.sci_id))
+
+    if len(unknown) > 0:
+        print("Keys not in the base namelist, added anyway: %s" % \
+              (", ".join(sorted(unknown))))
+
+def run_campaign(tasks, mpi=True, num_cores=None, ledger=None,
+                 work_queue=None, renew_every=60., poll_every=5.):
+    """
+    Run all the tasks, handing the next task to whichever worker goes idle
+    first. Tasks are dispatched in the order given, see order_tasks. If a
+    Ledger is given, each task's outcome is recorded as soon as it finishes.
+
+    Runs done in a node-local scratch directory are copied back to the
+    shared filesystem by a background copier thread, so the workers can get
+    on with the next run in the meantime. A task only counts as done once
+    its outputs are back.
+
+    If a WorkQueue is given, the task list is shared with other jobs: a task
+    is only claimed when a worker is free to start it, tasks claimed or run
+    by another job are skipped, and our claims are renewed every
+    renew_every seconds while they run.
+
+    Every poll_every seconds we check that the workers running tasks are
+    still alive; a task whose worker has died is recorded as failed.
+    """
+    if not mpi or len(tasks) == 0:
+        # Runs block, so our claims are renewed from a thread meanwhile
+        if work_queue is not None:
+            stop = threading.Event()
+            renewer = threading.Thread(target=renew_claims,
+                                       args=(work_queue, renew_every, stop))
+            renewer.daemon = True
+            renewer.start()
+        try:
+            for task in tasks:
+                if work_queue is not None and not work_queue.claim(task):
+                    continue
+                (task, status, staged) = run_task(task)
+                if staged is None:
+                    finish_task(task, status, ledger, work_queue)
+                else:
+                    copy_back_task(task, status, staged, ledger, work_queue)
+        finally:
+            if work_queue is not None:
+                stop.set()
+                renewer.join()
+        return
+
+    if num_cores is None: # use them all!
+        num_cores = mp.cpu_count()
+    num_cores = max(1, min(num_cores, len(tasks)))
+
+    copier = ThreadPoolExecutor(max_workers=2)
+
+    # Workers say which task they have started on, so a task whose worker
+    # dies (e.g. OOM-killed) can be failed rather than waited on forever
+    started = mp.SimpleQueue()
+    pool = mp.Pool(processes=num_cores, initializer=init_worker,
+                   initargs=(started,))
+    results = queue.Queue()
+    todo = iter(tasks)
+    dispatched = {} # task number -> task
+    running = {} # worker pid -> task number
+    lost = False
+    last_renew = time.time()
+    num = 0
+    while True:
+
+        # Keep every worker busy, but only claim a task when there is a
+        # worker free to run it
+        while len(dispatched) < num_cores:
+            task = next(todo, None)
+            if task is None:
+                break
+            if work_queue is not None and not work_queue.claim(task):
+                continue
+            num += 1
+            dispatched[num] = task
+            pool.apply_async(run_task_in_worker, (num, task),
+                             callback=results.put,
+                             error_callback=lambda error, num=num: \
+                                results.put((num, None, "failed", None)))
+
+        if len(dispatched) == 0:
+            break
+
+        try:
+            (num_done, task, status, staged) = results.get(timeout=poll_every)
+            task = dispatched.pop(num_done, None)
+            if task is not None:
+                if staged is None:
+                    finish_task(task, status, ledger, work_queue)
+                else:
+                    copier.submit(copy_back_task, task, status, staged,
+                                  ledger, work_queue)
+        except queue.Empty:
+            pass
+
+        while not started.empty():
+            (num_started, pid) = started.get()
+            running[pid] = num_started
+        for (pid, num_started) in list(running.items()):
+            if num_started not in dispatched:
+                del running[pid]
+            elif not process_exists(pid):
+                # The pool replaces the worker, the task is lost with it
+                del running[pid]
+                task = dispatched.pop(num_started)
+                print("Worker %d died running %s" % (pid, task_key(task)))
+                finish_task(task, "failed", ledger, work_queue)
+                lost = True
+
+        if work_queue is not None and time.time() - last_renew > renew_every:
+            work_queue.renew()
+            last_renew = time.time()
+
+    # A lost task is never cleared from the pool, which would stop it
+    # shutting down cleanly. All our tasks are over either way
+    pool.close()
+    if lost:
+        pool.terminate()
+    pool.join()
+    copier.shutdown(wait=True)
+
+_started = None
+
+def init_worker(started):
+    global _started
+    _started = started
+
+def run_task_in_worker(num, task):
+    _started.put((num, os.getpid()))
+    (task, status, staged) = run_task(task)
+
+    return (num, task, status, staged)
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+def renew_claims(work_queue, renew_every, stop):
+    """
+    Heartbeat our work queue claims every renew_every seconds until stop
+    is set.
+    """
+    while not stop.wait(renew_every):
+        work_queue.renew()
+
+def clear_spin_ups(tasks):
+    """
+    Throw away the tasks' spin-ups from a previous campaign, so a fresh
+    campaign spins every site up again (see RunCable.ensure_spun_up).
+    """
+    for task in tasks:
+        tag = "%s_R%d_S%d" % (task_site(task), task.repo_id, task.sci_id)
+        for fname in task.runner.spin_up_fnames(tag):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+def run_task(task):
+    """
+    Run a single task, returns the task, "done" or "failed" and anything
+    still to copy back from scratch. A failed site is reported and the rest
+    of the campaign carries on.
+    """
+    staged = None
+    try:
+        (error, staged) = task.runner.run_site(task.met_fname, task.url,
+                                               task.rev, task.sci_config,
+                                               task.repo_id, task.sci_id)
+    except Exception:
+        traceback.print_exc()
+        error = 1
+
+    if error == 0:
+        status = "done"
+    else:
+        status = "failed"
+
+    return (task, status, staged)
+
+def copy_back_task(task, status, staged, ledger, work_queue=None):
+    try:
+        task.runner.copy_back(staged)
+    except Exception:
+        traceback.print_exc()
+        status = "failed"
+    finish_task(task, status, ledger, work_queue)
+
+def finish_task(task, status, ledger, work_queue=None):
+    # Record the outcome before giving up the claim, so no other job can
+    # claim the task in between
+    if ledger is not None:
+        ledger.record(task, status)
+    if work_queue is not None:
+        work_queue.release(task)
+
+def task_site(task):
+    return os.path.basename(task.met_fname).split(".")[0]
+
+def task_key(task):
+    """
+    Identify a task across campaigns. The repo and science config themselves
+    are part of the key so editing repos/sci_configs between resubmissions
+    isn't mistaken for work that has already been done.
+    """
+    repo = os.path.basename(os.path.normpath(task.runner.cable_src))
+
+    return "%s_R%d_S%d_%s_%s" % (task_site(task), task.repo_id, task.sci_id,
+                                 repo, json.dumps(task.sci_config,
+                                                  sort_keys=True))
+
+
+class Ledger(object):
+    """
+    Persistent record of finished campaign tasks, so an interrupted campaign
+    (e.g. a PBS job hitting walltime) can be resumed rather than rerun.
+
+    Each outcome is appended as one line with O_APPEND and fsync'd, so the
+    ledger is never left with a half-recorded task; the latest line for a
+    task wins.
+    """
+
+    def __init__(self, fname=None):
+
+        self.fname = fname
+        self.offset = 0
+        self.counts = {}
+
+    def record(self, task, status):
+        row = json.dumps({"task": task_key(task), "status": status}) + "\n"
+        fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, row.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        status = {}
+        if not os.path.isfile(self.fname):
+            return status
+
+        with open(self.fname, "r") as f:
+            for row in f:
+                try:
+                    r = json.loads(row)
+                except ValueError:
+                    continue
+                status[r["task"]] = r["status"]
+
+        return status
+
+    def attempts(self):
+        """
+        Number of outcomes recorded for each task so far. Only the part of
+        the ledger added since the last call is read, as this is polled
+        (see WorkQueue) while other jobs append to it.
+        """
+        if not os.path.isfile(self.fname):
+            (self.offset, self.counts) = (0, {})
+            return {}
+        if os.path.getsize(self.fname) < self.offset:
+            (self.offset, self.counts) = (0, {})
+
+        with open(self.fname, "rb") as f:
+            f.seek(self.offset)
+            for row in f:
+                # Leave a partly written last line for next time
+                if not row.endswith(b"\n"):
+                    break
+                self.offset += len(row)
+                try:
+                    r = json.loads(row)
+                except ValueError:
+                    continue
+                self.counts[r["task"]] = self.counts.get(r["task"], 0) + 1
+
+        return self.counts
+
+    def pending(self, tasks):
+        """
+        The tasks that are missing from the ledger or that failed
+        """
+        status = self.read()
+
+        return [task for task in tasks \
+                    if status.get(task_key(task)) != "done"]
+
+    def reset(self):
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
@@ -14,8 +14,17 @@ import os
 import sys
 import subprocess
 import datetime
+import math
 
-def create_qsub_script(ofname, ncpus, mem, wall_time, project, email_address):
+from met_catalog import met_info
+
+def create_qsub_script(ofname, ncpus, mem, wall_time, project, email_address,
+                       resume=False, jobfs=None, nslices=1):
+    """
+    Write the qsub script. If nslices > 1 it is a PBS job array, each
+    element running one slice of the campaign (see
+    campaign.partition_tasks) with ncpus, mem and wall_time each.
+    """
 
     f = open(ofname, "w")
 
@@ -24,25 +33,92 @@ def create_qsub_script(ofname, ncpus, mem, wall_time, project, email_address):
     f.write("#PBS -l wd\n")
     f.write("#PBS -l ncpus=%d\n" % (ncpus))
     f.write("#PBS -l mem=%s\n" % (mem))
+    if jobfs is not None:
+        # node-local disk for the runs, see scratch_dir
+        f.write("#PBS -l jobfs=%s\n" % (jobfs))
     f.write("#PBS -l walltime=%s\n" % (wall_time))
     f.write("#PBS -q normal\n")
     f.write("#PBS -P %s\n" % (project))
     f.write("#PBS -j oe\n")
     f.write("#PBS -M %s\n" % (email_address))
     f.write("#PBS -l storage=gdata/w35+gdata/wd9\n")
+    if nslices > 1:
+        f.write("#PBS -J 0-%d\n" % (nslices - 1))
     f.write("\n")
     f.write("\n")
     f.write("\n")
     f.write("\n")
     f.write("source activate sci\n")
     f.write("module add netcdf/4.7.1\n")
-    f.write("python ./run_site_comparison.py --qsub\n")
+    cmd = "python ./run_site_comparison.py --qsub"
+    if resume:
+        # Resubmitting the same script carries on from the campaign ledger
+        cmd += " --resume"
+    if nslices > 1:
+        cmd += " --slice ${PBS_ARRAY_INDEX} --nslices %d" % (nslices)
+    f.write("%s\n" % (cmd))
     f.write("\n")
 
     f.close()
 
     os.chmod(ofname, 0o755)
 
+def size_array_job(slices, ncpus, secs_per_step, safety=2.0,
+                   min_wall_time=600.):
+    """
+    Resources for each element of a job array, from the met files in each
+    slice. PBS asks for the same resources for every element of an array,
+    so it has to be enough for the biggest slice.
+
+    Memory is allowed 4 times the largest met file (plus 512MB) per run,
+    for as many runs as will be going at once. The wall time is the longest
+    of the slice spread over ncpus or its longest single run, times safety.
+
+    Parameters:
+    ----------
+    slices : list
+        lists of Task tuples, see campaign.partition_tasks
+    ncpus : int
+        cores per array element
+    secs_per_step : float
+        model seconds per met timestep, see cable_utils.get_secs_per_step
+    safety : float
+        margin on the wall time estimate
+
+    Returns:
+    --------
+    mem : string
+        e.g. "8GB"
+    wall_time : string
+        e.g. "01:30:00"
+    """
+    nsteps = {}
+    size = {}
+    for tasks in slices:
+        for task in tasks:
+            if task.met_fname not in nsteps:
+                info = met_info(task.met_fname)
+                nsteps[task.met_fname] = info["nsteps"]
+                size[task.met_fname] = info["size"]
+
+    mem_gb = 1
+    secs = min_wall_time
+    for tasks in slices:
+        if len(tasks) == 0:
+            continue
+        largest = max(size[task.met_fname] for task in tasks)
+        run_mem = largest * 4 + 512 * 1024**2
+        mem_gb = max(mem_gb, math.ceil(min(ncpus, len(tasks)) * run_mem /
+                                       1024**3))
+
+        costs = [nsteps[task.met_fname] * secs_per_step for task in tasks]
+        secs = max(secs, max(sum(costs) / ncpus, max(costs)) * safety)
+
+    secs = int(math.ceil(secs / 60.) * 60)
+    wall_time = "%02d:%02d:%02d" % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+    return ("%dGB" % (mem_gb), wall_time)
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Cache of met files with LAI added (see cable_utils.change_LAI).
+
+The augmented met file only depends on the met file and the LAI (the
+site's LAI climatology or a fixed value), not on the repo or science
+config, so each one is built once and shared by every task for that site.
+Cached files are read-only and handed out as hard links, so a run keeps its
+copy even if the cache entry is evicted to stay under max_bytes; the least
+recently used entries go first. Runs in a scratch directory, usually on
+another filesystem, read the entry in place rather than copying it.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import time
+import glob
+import hashlib
+
+from cable_utils import file_hash
+from cable_utils import change_LAI
+from run_cache import link_or_copy
+
+class LAICache(object):
+
+    def __init__(self, cache_dir=None, max_bytes=None, lock_timeout=600.):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def fetch(self, met_fname, site, new_met_fname, fixed=None,
+              lai_dir=None):
+        """
+        Put the LAI-augmented version of met_fname at new_met_fname,
+        building it first if it isn't in the cache.
+
+        Parameters:
+        ----------
+        met_fname : string
+            met forcing file
+        site : string
+            site name, used to find the LAI file
+        new_met_fname : string
+            where the run wants its met file
+        fixed : float
+            fixed LAI value, used instead of the climatology
+        lai_dir : string
+            directory with the LAI climatologies
+        """
+        while True:
+            cached = self.get(met_fname, site, fixed, lai_dir)
+            try:
+                link_or_copy(cached, new_met_fname)
+                return
+            except FileNotFoundError:
+                # Evicted in the meantime
+                continue
+
+    def get(self, met_fname, site, fixed=None, lai_dir=None):
+        """
+        The cache entry for met_fname, built first if it isn't there, for
+        runs that read it in place (e.g. from a scratch directory on another
+        filesystem, where it can't be linked). Marks it as just used, so it
+        is the last thing evicted.
+        """
+        cached = self.entry_fname(met_fname, site, fixed, lai_dir)
+        while True:
+            if not os.path.isfile(cached):
+                self.build(cached, met_fname, site, fixed, lai_dir)
+            try:
+                os.utime(cached, None)
+                return cached
+            except FileNotFoundError:
+                # Evicted in the meantime
+                continue
+
+    def entry_fname(self, met_fname, site, fixed=None, lai_dir=None):
+        key = self.make_key(met_fname, site, fixed, lai_dir)
+
+        return os.path.join(self.cache_dir, "%s_met.nc" % (key))
+
+    def make_key(self, met_fname, site, fixed, lai_dir):
+        h = hashlib.sha256()
+        h.update(file_hash(met_fname).encode())
+        if fixed is not None:
+            h.update(("fixed=%r" % (fixed)).encode())
+        else:
+            lai_fname = os.path.join(lai_dir, "%s_lai.csv" % (site))
+            h.update(file_hash(lai_fname).encode())
+
+        return h.hexdigest()
+
+    def build(self, cached, met_fname, site, fixed, lai_dir):
+        """
+        Build a cache entry. Tasks for the same site tend to start together,
+        so only one worker builds it and the others wait for it to appear.
+        """
+        lock_fname = "%s.lock" % (cached)
+        while not os.path.isfile(cached):
+            try:
+                fd = os.open(lock_fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o644)
+            except FileExistsError:
+                # Builder died? Clear its lock and try again
+                try:
+                    age = time.time() - os.path.getmtime(lock_fname)
+                    if age > self.lock_timeout:
+                        os.remove(lock_fname)
+                except OSError:
+                    pass
+                time.sleep(0.1)
+                continue
+            os.close(fd)
+
+            tmp_fname = "%s.%d.tmp" % (cached, os.getpid())
+            try:
+                if not os.path.isfile(cached):
+                    change_LAI(met_fname, site, fixed=fixed, lai_dir=lai_dir,
+                               new_met_fname=tmp_fname)
+                    os.chmod(tmp_fname, 0o444)
+                    os.replace(tmp_fname, cached)
+            finally:
+                if os.path.isfile(tmp_fname):
+                    os.remove(tmp_fname)
+                os.remove(lock_fname)
+
+            self.evict(keep=cached)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries, other than keep, until the
+        cache fits in max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for fname in glob.glob(os.path.join(self.cache_dir, "*_met.nc")):
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+
+        total = sum(size for (mtime, size, fname) in entries)
+        for (mtime, size, fname) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if fname == keep:
+                continue
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
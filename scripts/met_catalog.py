@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Catalog of the met forcing files: what is in each file (time span,
+timestep, number of timesteps, location, variables, size and content hash)
+kept in a small JSON index, so planning a campaign doesn't mean opening and
+decoding every met file again.
+
+An entry is built from the file header and the first, second and last
+time values only, and is rebuilt whenever the file's size or mtime
+changes. The content hash is only worked out when something asks for it
+(see cable_utils.file_hash), then kept with the rest.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import json
+import fcntl
+import netCDF4
+
+class MetCatalog(object):
+
+    def __init__(self, index_fname=None):
+
+        self.index_fname = index_fname
+        self.changed = {}
+        self.load()
+
+    def load(self):
+        self.entries = self.read_index()
+
+    def read_index(self):
+        if self.index_fname is None or not os.path.isfile(self.index_fname):
+            return {}
+
+        try:
+            with open(self.index_fname, "r") as f:
+                return json.load(f)
+        except ValueError:
+            # Half-written or corrupt, it is only a cache
+            return {}
+
+    def save(self):
+        """
+        Write under a temporary name then rename, so several processes
+        saving at once can't leave a corrupt index. Our new entries are
+        merged into whatever is on disk first, under a lock, as pool
+        workers each have their own copy of the catalog and would otherwise
+        drop each other's.
+        """
+        if self.index_fname is None:
+            return
+
+        index_dir = os.path.dirname(self.index_fname)
+        if index_dir != "" and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        with open("%s.lock" % (self.index_fname), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.entries = self.read_index()
+            self.entries.update(self.changed)
+
+            tmp_fname = "%s.%d.tmp" % (self.index_fname, os.getpid())
+            with open(tmp_fname, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_fname, self.index_fname)
+
+        # Saved, and a forked worker shouldn't write them again
+        self.changed = {}
+
+    def scan(self, met_files):
+        """
+        Make sure every met file has an up to date entry, only the new or
+        changed files are read.
+        """
+        changed = False
+        for fname in met_files:
+            if self.lookup(fname) is None:
+                self.add(fname, read_met_header(fname))
+                changed = True
+
+        if changed:
+            self.save()
+
+    def get(self, fname):
+        """
+        Metadata for a met file, see read_met_header.
+        """
+        entry = self.lookup(fname)
+        if entry is None:
+            entry = read_met_header(fname)
+            self.add(fname, entry)
+            self.save()
+
+        return entry
+
+    def lookup(self, fname):
+        """
+        The entry for a file if we have one and the file hasn't changed
+        since, otherwise None.
+        """
+        entry = self.entries.get(os.path.abspath(fname))
+        if entry is None:
+            return None
+
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        if entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            return None
+
+        return entry
+
+    def get_hash(self, fname):
+        entry = self.lookup(fname)
+        if entry is None:
+            return None
+
+        return entry.get("hash")
+
+    def set_hash(self, fname, h):
+        entry = self.lookup(fname)
+        if entry is not None and entry.get("hash") != h:
+            entry["hash"] = h
+            self.add(fname, entry)
+            self.save()
+
+    def add(self, fname, entry):
+        self.entries[os.path.abspath(fname)] = entry
+        self.changed[os.path.abspath(fname)] = entry
+
+def read_met_header(fname):
+    """
+    Describe a met file from its header and the first/last time values.
+
+    Returns:
+    --------
+    entry : dictionary
+        start/end (ISO dates), st_yr/en_yr (years of the first/last
+        timestep), dt (s), nsteps, lat, lon, variables, size (bytes),
+        mtime_ns, and hash (None until known)
+    """
+    st = os.stat(fname)
+
+    nc = netCDF4.Dataset(fname, 'r')
+    time_var = nc.variables["time"]
+    nsteps = len(time_var)
+    calendar = getattr(time_var, "calendar", "standard")
+    if nsteps > 1:
+        times = time_var[[0, 1, nsteps - 1]]
+    else:
+        times = time_var[[0, 0, 0]]
+    dates = netCDF4.num2date(times, time_var.units, calendar=calendar)
+    secs = (dates[1] - dates[0]).total_seconds()
+
+    lat = None
+    lon = None
+    for (lat_name, lon_name) in [("latitude", "longitude"), ("lat", "lon")]:
+        if lat_name in nc.variables and lon_name in nc.variables:
+            lat = float(nc.variables[lat_name][:].ravel()[0])
+            lon = float(nc.variables[lon_name][:].ravel()[0])
+            break
+
+    entry = {"start": dates[0].isoformat(), "end": dates[2].isoformat(),
+             "st_yr": dates[0].year, "en_yr": dates[2].year, "dt": secs,
+             "nsteps": nsteps, "lat": lat, "lon": lon,
+             "variables": sorted(nc.variables.keys()),
+             "size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": None}
+    nc.close()
+
+    return entry
+
+# The catalog everything uses, in memory only until open_catalog is called
+_catalog = MetCatalog()
+
+def open_catalog(index_fname):
+    """
+    Use (and keep) the catalog in index_fname from now on.
+    """
+    global _catalog
+    _catalog = MetCatalog(index_fname)
+
+    return _catalog
+
+def get_catalog():
+    return _catalog
+
+def met_info(fname):
+    return _catalog.get(fname)
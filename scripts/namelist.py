@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+CABLE namelist file, parsed once into its groups and key = value lines so
+settings can be changed in memory and the result written out in one go.
+
+Keys are matched case-insensitively (as Fortran does), so e.g.
+CABLE_USER%YearStart replaces cable_user%YearStart rather than adding it a
+second time. Keys missing from the file are added at the end of the first
+group. Lines we don't change are written out exactly as they were read.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+
+class Namelist(object):
+
+    def __init__(self, fname=None, text=None):
+
+        self.lines = []
+        self.groups = []
+        self.index = {}
+
+        if fname is not None:
+            f = open(fname, "r")
+            text = f.read()
+            f.close()
+
+        if text is not None:
+            self.lines = text.splitlines()
+            self.parse()
+
+    def parse(self):
+        """
+        Index the groups and keys: groups is a list of [name, start, end]
+        line numbers and index maps lower case key -> line number.
+        """
+        self.groups = []
+        self.index = {}
+        for i, row in enumerate(self.lines):
+            line = row.strip()
+            # skip blank lines and comments, these can have "=" too
+            if not line or line.startswith("!"):
+                continue
+            elif line.startswith("&") and line.lower() != "&end":
+                self.groups.append([line[1:].lower(), i, None])
+            elif line.lower() == "&end" or line == "/":
+                if len(self.groups) > 0 and self.groups[-1][2] is None:
+                    self.groups[-1][2] = i
+            elif "=" in line:
+                key = line.split("=")[0].strip()
+                self.index[key.lower()] = i
+
+    def __contains__(self, key):
+        return key.lower() in self.index
+
+    def keys(self):
+        return [self.lines[i].split("=")[0].strip() \
+                    for i in sorted(self.index.values())]
+
+    def get(self, key, default=None):
+        """
+        Value of a key as written in the file, minus any trailing comment.
+        """
+        i = self.index.get(key.lower())
+        if i is None:
+            return default
+
+        return self.lines[i].split("=", 1)[1].split("!")[0].strip()
+
+    def update(self, replacements):
+        """
+        Set the params/flags in the namelist.
+
+        Parameters:
+        ----------
+        replacements : dictionary
+            dictionary of replacement values, key = value
+        """
+        missing = []
+        for key, val in replacements.items():
+            i = self.index.get(key.lower())
+            if i is None:
+                missing.append((key, val))
+                continue
+
+            # Keep the line's own indentation and spelling of the key
+            old_key = self.lines[i].split("=")[0].rstrip()
+            self.lines[i] = " ".join((old_key, "=", val.strip()))
+
+        if len(missing) > 0:
+            if len(self.groups) == 0 or self.groups[0][2] is None:
+                raise ValueError("No &end to add keys in front of")
+
+            # add 3 extra spaces at the front to line things up
+            new_lines = ["   %s = %s" % (key.strip(), val.strip()) \
+                            for (key, val) in missing]
+            end = self.groups[0][2]
+            self.lines[end:end] = new_lines
+            self.parse()
+
+    def copy(self):
+        new = Namelist()
+        new.lines = list(self.lines)
+        new.groups = [list(group) for group in self.groups]
+        new.index = dict(self.index)
+
+        return new
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+    def write(self, fname):
+        """
+        Write under a temporary name then rename, so a half-written
+        namelist is never visible.
+        """
+        tmp_fname = "%s.%d.tmp" % (fname, os.getpid())
+        f = open(tmp_fname, "w")
+        f.write(self.render())
+        f.close()
+        os.replace(tmp_fname, fname)
+
+_namelists = {}
+
+def read_namelist(fname):
+    """
+    Parsed copy of a namelist file. The parse is remembered per (path, size,
+    mtime), so the base cable.nml is only read once however many runs are
+    set up from it.
+    """
+    st = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+    if key not in _namelists:
+        _namelists[key] = Namelist(fname)
+
+    return _namelists[key].copy()
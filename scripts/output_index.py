@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Index of the CABLE site outputs in a directory, from one scan of it.
+
+Outputs are named <site>_R<repo_id>_S<sci_id>_out.nc (see
+RunCable.site_fnames), where site is the met file name without the .nc,
+so finding the trunk and branch outputs for a site and science config is
+a dictionary lookup rather than a glob of the directory.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import re
+
+OUT_FNAME = re.compile(r"^(?P<site>.+)_R(?P<repo_id>\d+)_S(?P<sci_id>\d+)"
+                       r"_out\.nc$")
+
+def index_outputs(output_dir):
+    """
+    Find the outputs in output_dir.
+
+    Returns:
+    --------
+    index : dictionary
+        (site, repo_id, sci_id) -> output filename
+    """
+    index = {}
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            match = OUT_FNAME.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            key = (match.group("site"), int(match.group("repo_id")),
+                   int(match.group("sci_id")))
+            index[key] = entry.path
+
+    return index
+
+def pair_outputs(index, old_repo_id=0, new_repo_id=1):
+    """
+    Pair up the old and new repo's outputs for each site and science
+    config.
+
+    Returns:
+    --------
+    pairs : list
+        (site, sci_id, old_fname, new_fname), sorted by site and sci_id
+    missing : list
+        (site, repo_id, sci_id) of outputs the other repo has but this one
+        doesn't
+    """
+    pairs = []
+    missing = []
+    keys = set((site, sci_id) for (site, repo_id, sci_id) in index \
+                    if repo_id in [old_repo_id, new_repo_id])
+    for (site, sci_id) in sorted(keys):
+        old_fname = index.get((site, old_repo_id, sci_id))
+        new_fname = index.get((site, new_repo_id, sci_id))
+        if old_fname is None:
+            missing.append((site, old_repo_id, sci_id))
+        elif new_fname is None:
+            missing.append((site, new_repo_id, sci_id))
+        else:
+            pairs.append((site, sci_id, old_fname, new_fname))
+
+    return (pairs, missing)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Cache of the reduced products of CABLE output files: the average seasonal
+cycle, annual means and average diurnal cycle of each benchmark variable.
+
+Products are worked out in one pass over the output (a chunk of timesteps
+at a time) and kept in a small npz sidecar named after the output's
+content hash and REDUCTION_VERSION, so the trunk output is only reduced
+once however many branches are compared against it, and re-plotting only
+reads the sidecars. Bump REDUCTION_VERSION whenever reduce_output changes.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import json
+import netCDF4
+import numpy as np
+
+from cable_utils import file_hash
+from cable_utils import get_month_index
+from cable_utils import get_seconds_of_day
+
+REDUCTION_VERSION = 1
+
+VARS = ["GPP", "NEE", "Qle", "Qh", "TVeg", "ESoil"]
+
+class ReductionCache(object):
+
+    def __init__(self, cache_dir=None):
+
+        self.cache_dir = cache_dir
+        self.index_fname = os.path.join(self.cache_dir, "index.json")
+        self.changed = {}
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.hashes = self.read_index()
+
+    def get(self, fname):
+        """
+        Reduced products of an output file, see reduce_output.
+        """
+        sidecar = os.path.join(self.cache_dir, "%s_v%d.npz" % \
+                                (self.make_key(fname), REDUCTION_VERSION))
+        if os.path.isfile(sidecar):
+            try:
+                with np.load(sidecar) as f:
+                    return dict(f.items())
+            except (OSError, ValueError):
+                # Half-written or corrupt, build it again
+                pass
+
+        products = reduce_output(fname)
+
+        # np.savez adds .npz to names that don't end in it
+        tmp_fname = "%s.%d.tmp" % (sidecar, os.getpid())
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, **products)
+        os.replace(tmp_fname, sidecar)
+
+        return products
+
+    def make_key(self, fname):
+        """
+        Content hash of an output file. Hashes are kept in the index per
+        (path, size, mtime) so an unchanged output isn't read to look up
+        its products.
+        """
+        st = os.stat(fname)
+        path = os.path.abspath(fname)
+        entry = self.hashes.get(path)
+        if entry is None or entry["size"] != st.st_size or \
+           entry["mtime_ns"] != st.st_mtime_ns:
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                     "hash": file_hash(fname)}
+            self.hashes[path] = entry
+            self.changed[path] = entry
+            self.save()
+
+        return entry["hash"]
+
+    def read_index(self):
+        if not os.path.isfile(self.index_fname):
+            return {}
+
+        try:
+            with open(self.index_fname, "r") as f:
+                return json.load(f)
+        except ValueError:
+            # Half-written or corrupt, it is only a cache
+            return {}
+
+    def save(self):
+        """
+        Write the index, merging our new hashes into whatever is on disk, so
+        several processes sharing the cache (e.g. the plot workers, each
+        with its own copy of it) don't drop each other's entries.
+        """
+        self.hashes = self.read_index()
+        self.hashes.update(self.changed)
+
+        tmp_fname = "%s.%d.tmp" % (self.index_fname, os.getpid())
+        with open(tmp_fname, "w") as f:
+            json.dump(self.hashes, f, indent=1, sort_keys=True)
+        os.replace(tmp_fname, self.index_fname)
+
+def reduce_output(fname, chunk_size=17520):
+    """
+    Reduce an output file to the products we plot/compare, reading
+    chunk_size timesteps at a time and keeping only per-month and per
+    time-of-day sums and counts. Units are converted on the way in.
+
+    Parameters:
+    ----------
+    fname : string
+        CABLE output filename
+    chunk_size : int
+        number of timesteps read at once (default a year of half-hours)
+
+    Returns:
+    --------
+    products : dictionary
+        years, the first year of the output onwards; hours, the start of
+        each time of day; and for each variable <var>_seasonal, the mean
+        over years of each calendar month's mean, <var>_annual, the mean
+        of each year, and <var>_diurnal, the mean at each time of day.
+        Periods without any valid data are NaN.
+    """
+    conversions = get_unit_conversions()
+
+    f = netCDF4.Dataset(fname)
+    time_var = f.variables['time']
+    nsteps = len(time_var)
+
+    # number the months from January of the first year
+    if nsteps > 1:
+        times = time_var[[0, 1, nsteps - 1]]
+    else:
+        times = time_var[[0, 0, 0]]
+    (first, last) = get_month_index(time_var, times[[0, 2]])
+    first -= first % 12
+    nmonths = (last - first) // 12 * 12 + 12
+
+    # bin the times of day by timestep
+    dt = get_seconds_of_day(time_var, times[:2])
+    dt = (dt[1] - dt[0]) % 86400
+    if dt == 0:
+        dt = 86400
+    nhours = max(86400 // dt, 1)
+
+    sums = dict((v, np.zeros(nmonths)) for v in VARS)
+    counts = dict((v, np.zeros(nmonths)) for v in VARS)
+    hour_sums = dict((v, np.zeros(nhours)) for v in VARS)
+    hour_counts = dict((v, np.zeros(nhours)) for v in VARS)
+    for start in range(0, nsteps, chunk_size):
+        stop = min(start + chunk_size, nsteps)
+        times = time_var[start:stop]
+        months = get_month_index(time_var, times) - first
+        hours = get_seconds_of_day(time_var, times) // dt % nhours
+
+        for v in VARS:
+            data = f.variables[v][start:stop]
+            data = np.ma.masked_invalid(data.reshape(stop - start, -1)[:,0])
+            ok = ~np.ma.getmaskarray(data)
+            data = data.compressed() * conversions[v]
+
+            sums[v] += np.bincount(months[ok], weights=data,
+                                   minlength=nmonths)
+            counts[v] += np.bincount(months[ok], minlength=nmonths)
+            hour_sums[v] += np.bincount(hours[ok], weights=data,
+                                        minlength=nhours)
+            hour_counts[v] += np.bincount(hours[ok], minlength=nhours)
+    f.close()
+
+    products = {"years": np.arange(first // 12, first // 12 + nmonths // 12),
+                "hours": np.arange(nhours) * dt / 3600.}
+    for v in VARS:
+        # monthly means, then the mean of those for each calendar month
+        monthly = mean_or_nan(sums[v].reshape(-1, 12),
+                              counts[v].reshape(-1, 12))
+        have = np.isfinite(monthly)
+        products["%s_seasonal" % (v)] = \
+            mean_or_nan(np.where(have, monthly, 0.0).sum(axis=0),
+                        have.sum(axis=0))
+        products["%s_annual" % (v)] = \
+            mean_or_nan(sums[v].reshape(-1, 12).sum(axis=1),
+                        counts[v].reshape(-1, 12).sum(axis=1))
+        products["%s_diurnal" % (v)] = mean_or_nan(hour_sums[v],
+                                                   hour_counts[v])
+
+    return products
+
+def mean_or_nan(sums, counts):
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+def get_unit_conversions():
+
+    UMOL_TO_MOL = 1E-6
+    MOL_C_TO_GRAMS_C = 12.0
+    SEC_2_DAY = 86400.
+
+    # umol/m2/s -> g/C/d, kg/m2/s -> mm/d
+    return {'GPP': UMOL_TO_MOL * MOL_C_TO_GRAMS_C * SEC_2_DAY,
+            'NEE': UMOL_TO_MOL * MOL_C_TO_GRAMS_C * SEC_2_DAY,
+            'Qle': 1.0, 'Qh': 1.0,
+            'TVeg': SEC_2_DAY, 'ESoil': SEC_2_DAY}
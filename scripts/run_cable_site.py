@@ -16,15 +16,36 @@ __email__ = "mdekauwe@gmail.com"
 import os
 import sys
 import glob
+import time
+import select
 import shutil
+import tempfile
 import subprocess
-import multiprocessing as mp
-import numpy as np
 
-from cable_utils import adjust_nml_file
 from cable_utils import get_svn_info
 from cable_utils import change_LAI
 from cable_utils import add_attributes_to_output_file
+from cable_utils import get_nsteps
+from cable_utils import write_run_stats
+from cable_utils import read_run_stats
+from cable_utils import get_secs_per_step
+from cable_utils import get_years
+from cable_utils import check_steady_state
+from namelist import read_namelist
+from run_cache import RunCache
+from lai_cache import LAICache
+from campaign import Task
+from campaign import order_tasks
+from campaign import run_campaign
+from campaign import render_namelists
+
+# The spin-up needs the carbon cycle on, so unless a science config says
+# otherwise both the spin-up and the run it starts use CN
+SPIN_UP_ICYCLE = "2"
+
+# Namelist keys a run started from its spin-up sets to its own files
+SPIN_UP_PATH_KEYS = ["filename%restart_in", "casafile%cnpipool",
+                     "casafile%cnpepool", "casafile%out"]
 
 class RunCable(object):
 
@@ -38,8 +59,12 @@ class RunCable(object):
                  cnpbiome_fname="pftlookup_csiro_v16_17tiles.csv",
                  elev_fname="GSWP3_gwmodel_parameters.nc",
                  lai_dir=None, fixed_lai=None, co2_conc=400.0,
-                 met_subset=[], cable_src=None, cable_exe="cable", mpi=True,
-                 num_cores=None, verbose=True):
+                 met_subset=[], cable_src=None, cable_exe="cable",
+                 local_exe="cable", cache_dir=None, lai_cache_dir=None,
+                 lai_cache_bytes=None, scratch_dir=None,
+                 timeout_factor=None, min_timeout=600., stall_time=None,
+                 spin_up=False, nyear_spinup=30, max_spin_cycles=20,
+                 mpi=True, num_cores=None, verbose=True):
 
         self.met_dir = met_dir
         self.log_dir = log_dir
@@ -61,105 +86,557 @@ class RunCable(object):
         self.met_subset = met_subset
         self.cable_src = cable_src
         self.cable_exe = os.path.join(cable_src, "offline/%s" % (cable_exe))
-        self.setup_exe()
+        self.setup_exe(local_exe)
         self.verbose = verbose
         self.mpi = mpi
         self.num_cores = num_cores
         self.lai_dir = lai_dir
         self.fixed_lai = fixed_lai
-
-
+        self.stats_fname = os.path.join(self.log_dir, "run_stats.jsonl")
+        if cache_dir is not None:
+            self.cache = RunCache(cache_dir=cache_dir)
+        else:
+            self.cache = None
+        if lai_cache_dir is not None:
+            self.lai_cache = LAICache(cache_dir=lai_cache_dir,
+                                      max_bytes=lai_cache_bytes)
+        else:
+            self.lai_cache = None
+        self.scratch_dir = scratch_dir
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.stall_time = stall_time
+        self.secs_per_step = None
+        self.spin_up = spin_up
+        self.nyear_spinup = nyear_spinup
+        self.max_spin_cycles = max_spin_cycles
 
     def main(self, sci_config, repo_id, sci_id):
 
         (met_files, url, rev) = self.initialise_stuff()
 
-        # Setup multi-processor jobs
-        if self.mpi:
-            if self.num_cores is None: # use them all!
-                self.num_cores = mp.cpu_count()
-            chunk_size = int(np.ceil(len(met_files) / float(self.num_cores)))
-            #if self.num_cores > len(met_files):
-            #    self.num_cores = len(met_files)
-
-            pool = mp.Pool(processes=self.num_cores)
-            jobs = []
-
-            for i in range(self.num_cores):
-                start = chunk_size * i
-                end = chunk_size * (i + 1)
-                if end > len(met_files):
-                    end = len(met_files)
-
-                # setup a list of processes that we want to run
-                p = mp.Process(target=self.worker,
-                               args=(met_files[start:end], url, rev,
-                                     sci_config, repo_id, sci_id, ))
-                p.start()
-                jobs.append(p)
-
-            # wait for all multiprocessing processes to finish
-            for j in jobs:
-                j.join()
-
+        tasks = [Task(self, fname, url, rev, sci_config, repo_id, sci_id) \
+                    for fname in met_files]
+        tasks = order_tasks(tasks)
+        render_namelists(tasks)
+        run_campaign(tasks, mpi=self.mpi, num_cores=self.num_cores)
+
+    def run_site(self, fname, url, rev, sci_config, repo_id, sci_id):
+        """
+        Run CABLE for a single site, returns the model's exit code (0 for a
+        cached run) and, if the run was done in a scratch directory, what
+        still needs copying back (see copy_back), otherwise None.
+        """
+        run = self.prepare_site(fname, url, rev, sci_config, repo_id, sci_id)
+        if run is None:
+            return (0, None)
+
+        (error, usage) = self.run_me(run["nml_fname"], cwd=run["work_dir"],
+                                     out_fname=run["run_out_fname"],
+                                     timeout=run["timeout"])
+
+        return self.finish_site(run, error, usage)
+
+    def write_namelist(self, fname, sci_config, repo_id, sci_id):
+        """
+        Write the namelist for a site run into namelist_dir, ahead of the
+        run (see campaign.render_namelists).
+
+        Anything the model writes is given relative to the directory it is
+        run from, i.e. run_dir or the run's own scratch directory, so the
+        namelist is the same whichever job or node ends up running it.
+
+        Returns:
+        --------
+        unknown : list
+            keys set that weren't in the base namelist
+        """
+        site = os.path.basename(fname).split(".")[0]
+        tag = "%s_R%s_S%s" % (site, repo_id, sci_id)
+        (out_fname, out_log_fname) = self.site_fnames(site, repo_id, sci_id)
+
+        # In scratch, inputs are given as absolute paths as the model is run
+        # from inside that directory
+        if self.scratch_dir is not None:
+            out_fname = os.path.basename(out_fname)
+            out_log_fname = os.path.basename(out_log_fname)
+            fix_path = os.path.abspath
         else:
-            self.worker(met_files, url, rev, sci_config, repo_id, sci_id,)
-
-    def worker(self, met_files, url, rev, sci_config, repo_id, sci_id):
-        cwd = os.getcwd()
-
-        for fname in met_files:
+            fix_path = lambda fname: fname
+
+        replace_dict = self.get_replacements(fname, tag, out_fname,
+                                             out_log_fname, fix_path)
+
+        # Start from the spun up state, see spin_up_site. The run then has
+        # CASA on too, so give it its own CASA output and final pool files
+        if self.spin_up:
+            (restart_fname, pool_fname) = self.spin_up_fnames(tag)
+            (casa_out_fname, pool_out_fname) = self.casa_fnames(tag)
+            if self.scratch_dir is not None:
+                casa_out_fname = os.path.basename(casa_out_fname)
+                pool_out_fname = os.path.basename(pool_out_fname)
+            replace_dict["filename%restart_in"] = "'%s'" % \
+                                                    (fix_path(restart_fname))
+            replace_dict["casafile%cnpipool"] = "'%s'" % \
+                                                    (fix_path(pool_fname))
+            replace_dict["casafile%cnpepool"] = "'%s'" % (pool_out_fname)
+            replace_dict["casafile%out"] = "'%s'" % (casa_out_fname)
+            replace_dict["icycle"] = SPIN_UP_ICYCLE
+
+        # Make sure the dict isn't empty
+        if bool(sci_config):
+            replace_dict = merge_two_dicts(replace_dict, sci_config)
+
+        base_nml_fn = os.path.join(self.grid_dir, "%s" % (self.nml_fname))
+        nml = read_namelist(base_nml_fn)
+        unknown = [key for key in replace_dict if key not in nml]
+        nml.update(replace_dict)
+        nml.write(os.path.join(self.namelist_dir, "cable_%s.nml" % (tag)))
+
+        return unknown
+
+    def get_replacements(self, fname, tag, out_fname, out_log_fname,
+                         fix_path):
+        """
+        Namelist settings common to all site runs, fix_path is applied to
+        the input files.
+        """
+        # Add LAI to met file? Named per repo/config as other tasks for the
+        # same site may be running at the same time. Runs in scratch read
+        # the LAI cache's copy where it is, see prepare_site
+        if self.lai_in_place():
             site = os.path.basename(fname).split(".")[0]
+            fname = os.path.abspath(self.lai_cache.entry_fname(fname, site,
+                                                    fixed=self.fixed_lai,
+                                                    lai_dir=self.lai_dir))
+        elif self.fixed_lai is not None or self.lai_dir is not None:
+            fname = "%s_tmp.nc" % (tag)
+        else:
+            fname = fix_path(fname)
+
+        replace_dict = {
+                        "filename%met": "'%s'" % (fname),
+                        "filename%out": "'%s'" % (out_fname),
+                        "filename%log": "'%s'" % (out_log_fname),
+                        "filename%restart_out": "' '",
+                        "filename%type": "'%s'" % (fix_path(self.grid_fname)),
+                        "filename%veg": "'%s'" % (fix_path(self.veg_fname)),
+                        "filename%soil": "'%s'" % (fix_path(self.soil_fname)),
+                        "output%restart": ".FALSE.",
+                        "fixedCO2": "%.2f" % (self.co2_conc),
+                        "casafile%phen": "'%s'" % (fix_path(self.phen_fname)),
+                        "casafile%cnpbiome": "'%s'" % \
+                                (fix_path(self.cnpbiome_fname)),
+                        "spinup": ".FALSE.",
+        }
+
+        return replace_dict
+
+    def spin_up_site(self, fname, sci_config, repo_id, sci_id):
+        """
+        Spin up the carbon pools for a site run, cycling the met data over
+        the spin-up years from get_years, one model run per cycle, until
+        check_steady_state says the pools have stopped changing (or we have
+        done max_spin_cycles). Each run starts from the restart and pool
+        files the previous cycle left.
+
+        Cycles work on files named by our pid, so a second job spinning up
+        the same site can't trample them; only once the spin-up is over are
+        they renamed to the files the site's actual run starts from (see
+        write_namelist and spin_up_fnames).
+
+        Returns:
+        --------
+        num : int
+            number of cycles run
+        converged : bool
+            whether the pools reached equilibrium
+        """
+        site = os.path.basename(fname).split(".")[0]
+        tag = "%s_R%s_S%s" % (site, repo_id, sci_id)
+        experiment_id = "%s_spin_%d" % (tag, os.getpid())
+        restart_fname = os.path.join(self.restart_dir,
+                                     "%s_restart.nc" % (experiment_id))
+        pool_fname = os.path.join(self.restart_dir,
+                                  "%s_pool.csv" % (experiment_id))
+        out_fname = os.path.join(self.output_dir,
+                                 "%s_out.nc" % (experiment_id))
+        out_log_fname = os.path.join(self.log_dir,
+                                     "%s_log.txt" % (experiment_id))
+        nml_fname = os.path.join(self.namelist_dir,
+                                 "cable_%s.nml" % (experiment_id))
+
+        (st_yr, en_yr, st_yr_trans, en_yr_trans,
+         st_yr_spin, en_yr_spin) = get_years(fname, self.nyear_spinup)
+
+        # Each cycle goes through the met record nloop times
+        nloop = (en_yr_spin - st_yr_spin + 1) / (en_yr - st_yr + 1)
+        timeout = self.get_timeout(fname, scale=nloop)
+
+        # Spin up in place, from run_dir
+        add_lai = self.fixed_lai is not None or self.lai_dir is not None
+        lai_fname = "%s_tmp.nc" % (experiment_id)
+        if add_lai:
+            if self.lai_cache is not None:
+                self.lai_cache.fetch(fname, site, lai_fname,
+                                     fixed=self.fixed_lai,
+                                     lai_dir=self.lai_dir)
+            else:
+                change_LAI(fname, site, fixed=self.fixed_lai,
+                           lai_dir=self.lai_dir, new_met_fname=lai_fname)
+
+        replace_dict = self.get_replacements(fname, tag, out_fname,
+                                             out_log_fname,
+                                             lambda fname: fname)
+        if add_lai:
+            replace_dict["filename%met"] = "'%s'" % (lai_fname)
+        replace_dict.update({
+                        "filename%restart_out": "'%s'" % (restart_fname),
+                        "output%restart": ".TRUE.",
+                        "casafile%cnpepool": "'%s'" % (pool_fname),
+                        "cable_user%YearStart": "%d" % (st_yr_spin),
+                        "cable_user%YearEnd": "%d" % (en_yr_spin),
+                        "cable_user%MetType": "'site'",
+                        "cable_user%CASA_OUT_FREQ": "'annually'",
+                        "icycle": SPIN_UP_ICYCLE,
+        })
+        if bool(sci_config):
+            replace_dict = merge_two_dicts(replace_dict, sci_config)
+
+        base_nml_fn = os.path.join(self.grid_dir, "%s" % (self.nml_fname))
+
+        num = 0
+        error = 0
+        not_in_equilibrium = True
+        while not_in_equilibrium and num < self.max_spin_cycles:
+            num += 1
+            if num == 1:
+                cycle = {"filename%restart_in": "' '",
+                         "casafile%cnpipool": "''",
+                         "cable_user%CASA_fromZero": ".TRUE."}
+            else:
+                cycle = {"filename%restart_in": "'%s'" % (restart_fname),
+                         "casafile%cnpipool": "'%s'" % (pool_fname),
+                         "cable_user%CASA_fromZero": ".FALSE."}
+            cycle["casafile%out"] = "'%s'" % \
+                (os.path.join(self.output_dir, "%s_out_CASA_ccp%d.nc" % \
+                              (experiment_id, num)))
+
+            nml = read_namelist(base_nml_fn)
+            nml.update(merge_two_dicts(replace_dict, cycle))
+            nml.write(nml_fname)
+
+            (error, usage) = self.run_me(nml_fname, out_fname=out_fname,
+                                         timeout=timeout)
+            if error != 0:
+                break
+
+            not_in_equilibrium = check_steady_state(experiment_id,
+                                                    self.output_dir, num,
+                                                    debug=self.verbose)
+
+            # Only the previous cycle is needed for the next check
+            self.remove_files([os.path.join(self.output_dir,
+                                            "%s_out_CASA_ccp%d.nc" % \
+                                                (experiment_id, num - 1))])
+
+        # Hand the final state over to the site's run
+        if error == 0:
+            (final_restart, final_pool) = self.spin_up_fnames(tag)
+            os.replace(restart_fname, final_restart)
+            if os.path.isfile(pool_fname):
+                os.replace(pool_fname, final_pool)
 
-            base_nml_fn = os.path.join(self.grid_dir, "%s" % (self.nml_fname))
-            nml_fname = "cable_%s_R%s_S%s.nml" % (site, repo_id, sci_id)
-            shutil.copy(base_nml_fn, nml_fname)
-            #nml_fname = os.path.join(cwd, nml_fname)
-
-            (out_fname,
-             out_log_fname) = self.clean_up_old_files(site, repo_id, sci_id)
-
-            # Add LAI to met file?
-            if self.fixed_lai is not None or self.lai_dir is not None:
-                fname = change_LAI(fname, site, fixed=self.fixed_lai,
+        if os.path.isfile(out_log_fname):
+            os.replace(out_log_fname, os.path.join(self.log_dir,
+                                                   "%s_spin_log.txt" % (tag)))
+        self.remove_files([restart_fname, pool_fname, out_fname, nml_fname,
+                           os.path.join(self.output_dir,
+                                        "%s_out_CASA_ccp%d.nc" % \
+                                            (experiment_id, num))])
+        if add_lai:
+            self.remove_files([lai_fname])
+
+        return (num, error == 0 and not not_in_equilibrium)
+
+    def ensure_spun_up(self, fname, sci_config, repo_id, sci_id):
+        """
+        Spin up a site run unless it already has been, e.g. by an earlier
+        attempt at the task that was interrupted before the run finished
+        (a fresh campaign starts by clearing these, see
+        campaign.clear_spin_ups). Raises RuntimeError if the spin-up fails.
+        """
+        site = os.path.basename(fname).split(".")[0]
+        tag = "%s_R%s_S%s" % (site, repo_id, sci_id)
+        (restart_fname, pool_fname) = self.spin_up_fnames(tag)
+        if os.path.isfile(restart_fname):
+            return
+
+        (num, converged) = self.spin_up_site(fname, sci_config, repo_id,
+                                             sci_id)
+        if not os.path.isfile(restart_fname):
+            raise RuntimeError("Spin-up failed: %s" % (tag))
+        if not converged:
+            print("Spin-up not in equilibrium after %d cycles: %s" % \
+                  (num, tag))
+
+    def remove_files(self, fnames):
+        for fname in fnames:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def spin_up_fnames(self, tag):
+        """
+        Restart and CASA pool files a site run's spin-up finishes with.
+        """
+        restart_fname = os.path.join(self.restart_dir,
+                                     "%s_spin_restart.nc" % (tag))
+        pool_fname = os.path.join(self.restart_dir,
+                                  "%s_spin_pool.csv" % (tag))
+
+        return (restart_fname, pool_fname)
+
+    def casa_fnames(self, tag):
+        """
+        CASA output and final pool files of a site run started from its
+        spin-up.
+        """
+        casa_out_fname = os.path.join(self.output_dir,
+                                      "%s_out_CASA.nc" % (tag))
+        pool_out_fname = os.path.join(self.restart_dir,
+                                      "%s_pool_out.csv" % (tag))
+
+        return (casa_out_fname, pool_out_fname)
+
+    def prepare_site(self, fname, url, rev, sci_config, repo_id, sci_id,
+                     spin_up=True):
+        """
+        Everything up to running the model: clear out old outputs, check the
+        cache, spin up the site and add LAI to the met file. The namelist
+        has already been written by write_namelist. Returns a dictionary
+        describing the run, or None if it was found in the cache.
+
+        With spin_up False the spin-up is left to the caller, who must call
+        ensure_spun_up (or discard_site) before the run.
+        """
+        site = os.path.basename(fname).split(".")[0]
+        tag = "%s_R%s_S%s" % (site, repo_id, sci_id)
+
+        (out_fname,
+         out_log_fname) = self.clean_up_old_files(site, repo_id, sci_id)
+
+        # Run in a private directory on node-local disk? Nothing but the
+        # final outputs then touch the shared filesystem
+        if self.scratch_dir is not None:
+            work_dir = tempfile.mkdtemp(prefix="%s_" % (tag),
+                                        dir=self.scratch_dir)
+            run_out_fname = os.path.join(work_dir,
+                                         os.path.basename(out_fname))
+            run_log_fname = os.path.join(work_dir,
+                                         os.path.basename(out_log_fname))
+        else:
+            work_dir = ""
+            (run_out_fname, run_log_fname) = (out_fname, out_log_fname)
+
+        nml_fname = os.path.join(self.namelist_dir, "cable_%s.nml" % (tag))
+
+        met_fname = fname
+        add_lai = self.fixed_lai is not None or self.lai_dir is not None
+        if add_lai:
+            fname = os.path.join(work_dir, "%s_tmp.nc" % (tag))
+        lai_in_place = self.lai_in_place()
+
+        # Have we already run exactly this before?
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.get_cache_key(nml_fname, met_fname, site)
+            if self.cache.fetch(cache_key, out_fname, out_log_fname):
+                if work_dir != "":
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+                # The cached output is as the model wrote it, so it gets
+                # this run's provenance, not that of the run that filled it
+                add_attributes_to_output_file(nml_fname, out_fname,
+                                              sci_config, url, rev)
+                return None
+
+        try:
+            # The spin-up is just the first stage of the task, so whichever
+            # job claimed the task does it and no run waits on other sites'
+            if self.spin_up and spin_up:
+                self.ensure_spun_up(met_fname, sci_config, repo_id, sci_id)
+
+            if lai_in_place:
+                self.lai_cache.get(met_fname, site, fixed=self.fixed_lai,
                                    lai_dir=self.lai_dir)
-
-            replace_dict = {
-                            "filename%met": "'%s'" % (fname),
-                            "filename%out": "'%s'" % (out_fname),
-                            "filename%log": "'%s'" % (out_log_fname),
-                            "filename%restart_out": "' '",
-                            "filename%type": "'%s'" % (self.grid_fname),
-                            "filename%veg": "'%s'" % (self.veg_fname),
-                            "filename%soil": "'%s'" % (self.soil_fname),
-                            "output%restart": ".FALSE.",
-                            "fixedCO2": "%.2f" % (self.co2_conc),
-                            "casafile%phen": "'%s'" % (self.phen_fname),
-                            "casafile%cnpbiome": "'%s'" % (self.cnpbiome_fname),
-                            "spinup": ".FALSE.",
-            }
-
-            # Make sure the dict isn't empty
-            if bool(sci_config):
-                replace_dict = merge_two_dicts(replace_dict, sci_config)
-            adjust_nml_file(nml_fname, replace_dict)
-
-            self.run_me(nml_fname)
-
-            add_attributes_to_output_file(nml_fname, out_fname, sci_config,
-                                          url, rev)
-            shutil.move(nml_fname, os.path.join(self.namelist_dir, nml_fname))
-
-            if self.fixed_lai is not None or self.lai_dir is not None:
-                os.remove("%s_tmp.nc" % (site))
-
-    def setup_exe(self):
-        # delete local executable, copy a local copy and use that
-        #local_exe = os.path.join(cwd, "cable")
-        local_exe = "cable"
-        if os.path.isfile(local_exe):
-            os.remove(local_exe)
-        shutil.copy(self.cable_exe, local_exe)
+            elif add_lai and self.lai_cache is not None:
+                self.lai_cache.fetch(met_fname, site, fname,
+                                     fixed=self.fixed_lai,
+                                     lai_dir=self.lai_dir)
+            elif add_lai:
+                change_LAI(met_fname, site, fixed=self.fixed_lai,
+                           lai_dir=self.lai_dir, new_met_fname=fname)
+        except Exception:
+            # Don't leave the run's scratch directory behind
+            if work_dir != "":
+                shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+
+        run = {"site": site, "tag": tag, "repo_id": repo_id,
+               "sci_id": sci_id, "sci_config": sci_config, "url": url,
+               "rev": rev, "work_dir": work_dir, "nml_fname": nml_fname,
+               "met_fname": met_fname, "lai_fname": None,
+               "out_fname": out_fname, "out_log_fname": out_log_fname,
+               "run_out_fname": run_out_fname,
+               "run_log_fname": run_log_fname, "cache_key": cache_key,
+               "stdout_fname": os.path.join(work_dir or self.log_dir,
+                                            "%s_stdout.txt" % (tag)),
+               "timeout": self.get_timeout(met_fname)}
+        if add_lai and not lai_in_place:
+            run["lai_fname"] = fname
+
+        return run
+
+    def discard_site(self, run):
+        """
+        Clear up after a prepared run that won't now go ahead.
+        """
+        if run["lai_fname"] is not None:
+            self.remove_files([run["lai_fname"]])
+        if run["work_dir"] != "":
+            shutil.rmtree(run["work_dir"], ignore_errors=True)
+
+    def lai_in_place(self):
+        """
+        Do runs read their LAI met file straight from the LAI cache? Yes for
+        runs in scratch, which is usually another filesystem so it would
+        mean copying the whole met file for every run.
+        """
+        add_lai = self.fixed_lai is not None or self.lai_dir is not None
+
+        return add_lai and self.lai_cache is not None and \
+                self.scratch_dir is not None
+
+    def finish_site(self, run, error, usage):
+        """
+        Everything after running the model: record the run stats and add
+        the run's provenance to the output. Returns the same as run_site.
+        """
+        stats = {"site": run["site"], "repo_id": run["repo_id"],
+                 "sci_id": run["sci_id"],
+                 "nsteps": get_nsteps(run["met_fname"]), "exit_code": error}
+        stats.update(usage)
+        write_run_stats(self.stats_fname, stats)
+
+        if error == 0:
+            # Cache the output before this run's provenance goes on it
+            if run["cache_key"] is not None:
+                self.cache.store(run["cache_key"], run["run_out_fname"],
+                                 run["run_log_fname"])
+
+            add_attributes_to_output_file(run["nml_fname"],
+                                          run["run_out_fname"],
+                                          run["sci_config"], run["url"],
+                                          run["rev"])
+
+        if run["lai_fname"] is not None:
+            os.remove(run["lai_fname"])
+
+        staged = {"work_dir": run["work_dir"],
+                  "files": [(run["run_log_fname"], run["out_log_fname"]),
+                            (run["run_out_fname"], run["out_fname"]),
+                            (run["stdout_fname"],
+                             os.path.join(self.log_dir,
+                                    os.path.basename(run["stdout_fname"])))]}
+
+        # With CASA on the run also writes its CASA output and final pools
+        if self.spin_up:
+            for fname in self.casa_fnames(run["tag"]):
+                if run["work_dir"] != "":
+                    src = os.path.join(run["work_dir"],
+                                       os.path.basename(fname))
+                else:
+                    src = fname
+                staged["files"].append((src, fname))
+
+        if run["work_dir"] != "":
+            return (error, staged)
+
+        # Running in place, so just the stdout log to move
+        self.copy_back(staged)
+
+        return (error, None)
+
+    def copy_back(self, staged):
+        """
+        Move a finished run's log and outputs to their final home. Outputs
+        are copied under a temporary name and renamed, so a partial output
+        never appears in output_dir.
+        """
+        for (src, dst) in staged["files"]:
+            if src == dst or not os.path.isfile(src):
+                continue
+            if staged["work_dir"] == "":
+                shutil.move(src, dst)
+            else:
+                tmp_fname = "%s.tmp" % (dst)
+                shutil.copyfile(src, tmp_fname)
+                os.replace(tmp_fname, dst)
+
+        if staged["work_dir"] != "":
+            shutil.rmtree(staged["work_dir"], ignore_errors=True)
+
+    def get_timeout(self, met_fname, scale=1.0):
+        """
+        How long a run can have before we give up on it: timeout_factor
+        times the expected run time from the met length (times scale, for
+        runs that go through the met record more than once) and the average
+        seconds per timestep of past runs. None (no limit) if timeouts are
+        off or nothing has been run before.
+        """
+        if self.timeout_factor is None:
+            return None
+
+        if self.secs_per_step is None:
+            records = read_run_stats(self.stats_fname)
+            self.secs_per_step = get_secs_per_step(records)
+            if self.secs_per_step is None:
+                return None
+
+        expected = get_nsteps(met_fname) * scale * self.secs_per_step
+
+        return max(self.min_timeout, self.timeout_factor * expected)
+
+    def get_cache_key(self, nml_fname, met_fname, site):
+
+        input_fnames = [met_fname, self.grid_fname, self.veg_fname,
+                        self.soil_fname, self.phen_fname, self.cnpbiome_fname]
+        if self.lai_dir is not None:
+            input_fnames.append(os.path.join(self.lai_dir,
+                                             "%s_lai.csv" % (site)))
+
+        # The run starts from the spun up state, which is worked out from
+        # the same executable, namelist and inputs, so the spin-up settings
+        # are all the key needs to tell a hit before spinning up. The spin-up
+        # files and the run's CASA files are only paths here
+        if self.spin_up:
+            return self.cache.make_key(self.cable_exe, nml_fname, input_fnames,
+                                       extra=(self.fixed_lai,
+                                              self.nyear_spinup,
+                                              self.max_spin_cycles),
+                                       path_only=SPIN_UP_PATH_KEYS)
+
+        return self.cache.make_key(self.cable_exe, nml_fname, input_fnames,
+                                   extra=self.fixed_lai)
+
+    def setup_exe(self, local_exe):
+        # replace the local executable with a fresh copy and use that. Each
+        # repo needs its own local name as all repos now share the same pool.
+        # Copy then rename, as other jobs sharing the run dir may be running
+        # the old copy
+        tmp_exe = "%s.%d.tmp" % (local_exe, os.getpid())
+        shutil.copy(self.cable_exe, tmp_exe)
+        os.replace(tmp_exe, local_exe)
         self.cable_exe = local_exe
 
     def initialise_stuff(self):
@@ -188,38 +665,223 @@ class RunCable(object):
 
         return (met_files, url, rev)
 
-    def clean_up_old_files(self, site, repo_id, sci_id):
+    def site_fnames(self, site, repo_id, sci_id):
         out_fname = os.path.join(self.output_dir, "%s_R%s_S%s_out.nc" % \
                                  (site, repo_id, sci_id))
+        out_log_fname = os.path.join(self.log_dir, "%s_R%s_S%s_log.txt" % \
+                                     (site, repo_id, sci_id))
+
+        return (out_fname, out_log_fname)
+
+    def clean_up_old_files(self, site, repo_id, sci_id):
+        (out_fname, out_log_fname) = self.site_fnames(site, repo_id, sci_id)
         if os.path.isfile(out_fname):
             os.remove(out_fname)
 
-        out_log_fname = os.path.join(self.log_dir, "%s_R%s_S%s_log.txt" % \
-                                     (site, repo_id, sci_id))
         if os.path.isfile(out_log_fname):
             os.remove(out_log_fname)
 
-        return (out_fname, out_log_fname)
+        # LAI met file left in run_dir by an interrupted run
+        lai_fname = "%s_R%s_S%s_tmp.nc" % (site, repo_id, sci_id)
+        if os.path.isfile(lai_fname):
+            os.remove(lai_fname)
 
-    def run_me(self, nml_fname):
+        return (out_fname, out_log_fname)
 
+    def run_me(self, nml_fname, cwd="", out_fname=None, timeout=None):
+        """
+        Run the model (from the directory cwd, if given), returns the exit
+        code and the resources the run used (see wait_for_run).
 
-        # run the model
+        A run that goes over timeout (s), or whose output file out_fname
+        stops growing for stall_time (s), is killed, see Watchdog.
+        """
+        cmd = [os.path.abspath(self.cable_exe), os.path.abspath(nml_fname)]
         if self.verbose:
-            cmd = './%s %s' % (self.cable_exe, nml_fname)
-            try:
-                error = subprocess.call(cmd, shell=True)
-            except:
-                print("Job failed to submit: %s", error)
-                raise
+            stdout = None
+            stderr = None
         else:
             # No outputs to the screen: stout and stderr to dev/null
-            cmd = './%s %s > /dev/null 2>&1' % (self.cable_exe, nml_fname)
-            error = subprocess.call(cmd, shell=True)
-            if error == 1:
-                print("Job failed to submit")
-
-
+            stdout = subprocess.DEVNULL
+            stderr = subprocess.DEVNULL
+
+        start = time.time()
+        try:
+            p = subprocess.Popen(cmd, stdout=stdout, stderr=stderr,
+                                 cwd=cwd or None)
+        except OSError:
+            print("Job failed to submit: %s" % (" ".join(cmd)))
+            raise
+
+        # Poll until the run exits (without reaping it, see wait_for_run),
+        # giving up on it if it hangs
+        killed = None
+        watchdog = Watchdog(out_fname, timeout=timeout,
+                            stall_time=self.stall_time)
+        if watchdog.active() and hasattr(os, "waitid"):
+            while not wait_for_exit(p.pid, watchdog.poll_every):
+                killed = watchdog.check()
+                if killed is not None:
+                    p.kill()
+                    break
+
+        (error, usage) = wait_for_run(p.pid)
+        usage["wall_time"] = time.time() - start
+        usage["killed"] = killed
+
+        # We reaped the child ourselves, stop Popen trying to do it again
+        p.returncode = error
+        if killed is not None:
+            print("Job killed: %s, %s" % (" ".join(cmd), killed))
+        elif error != 0:
+            print("Job failed: %s, exit code %d" % (" ".join(cmd), error))
+
+        return (error, usage)
+
+
+class Watchdog(object):
+    """
+    Decide when a run has hung: it has gone over its timeout, or its output
+    file hasn't grown for stall_time seconds (including never appearing).
+    """
+
+    def __init__(self, out_fname=None, timeout=None, stall_time=None,
+                 poll_every=5.0):
+
+        self.out_fname = out_fname
+        self.timeout = timeout
+        self.stall_time = stall_time
+        self.poll_every = poll_every
+        self.start = time.time()
+        self.last_size = -1
+        self.last_growth = self.start
+
+    def active(self):
+        return self.timeout is not None or self.stall_time is not None
+
+    def check(self):
+        """
+        Returns why the run should be killed, or None if it is fine.
+        """
+        now = time.time()
+        if self.timeout is not None and now - self.start > self.timeout:
+            return "timed out after %.0f s" % (now - self.start)
+
+        if self.stall_time is not None and self.out_fname is not None:
+            try:
+                size = os.path.getsize(self.out_fname)
+            except OSError:
+                size = -1
+
+            if size > self.last_size:
+                self.last_size = size
+                self.last_growth = now
+            elif now - self.last_growth > self.stall_time:
+                return "output stopped growing %.0f s ago" % \
+                        (now - self.last_growth)
+
+        return None
+
+def wait_for_exit(pid, timeout):
+    """
+    Wait up to timeout (s) for a process to exit, without reaping it.
+    Returns True if it has exited.
+    """
+    if hasattr(os, "pidfd_open"):
+        # The pidfd becomes readable when the process exits
+        fd = os.pidfd_open(pid)
+        try:
+            select.select([fd], [], [], timeout)
+        finally:
+            os.close(fd)
+    else:
+        end = time.time() + timeout
+        while time.time() < end:
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | \
+                         os.WNOWAIT) is not None:
+                return True
+            time.sleep(0.1)
+
+    return os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | \
+                     os.WNOWAIT) is not None
+
+def wait_for_run(pid):
+    """
+    Wait for a model run to finish and collect what it used: user/sys CPU
+    time (s), peak resident set size (kB) and bytes read/written.
+
+    We wait for the exit without reaping the process first, as
+    /proc/<pid>/io is only there until the process is reaped. rchar/wchar
+    are all bytes passed through read/write calls, read_bytes/write_bytes
+    are what actually hit the storage layer (usually zero on Lustre).
+    """
+    io = {}
+    try:
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(pid)
+    except (AttributeError, OSError):
+        # No waitid/procfs (e.g. a mac), just go without the I/O numbers
+        pass
+
+    (_, status, ru) = os.wait4(pid, 0)
+    error = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in bytes on a mac, kB on linux
+    max_rss = ru.ru_maxrss
+    if sys.platform == "darwin":
+        max_rss /= 1024.
+
+    usage = {"user_time": ru.ru_utime, "sys_time": ru.ru_stime,
+             "max_rss_kb": max_rss}
+    for key in ["rchar", "wchar", "read_bytes", "write_bytes"]:
+        usage[key] = io.get(key)
+
+    return (error, usage)
+
+def sample_proc_usage(pid):
+    """
+    Snapshot of what a still running process has used so far, in the same
+    units as wait_for_run. Used where we can't reap the process ourselves
+    (i.e. asyncio), so the numbers are only as fresh as the last sample.
+    Returns None once the process has gone.
+    """
+    try:
+        fp = open("/proc/%d/stat" % (pid), "r")
+        stat = fp.read()
+        fp.close()
+        fp = open("/proc/%d/status" % (pid), "r")
+        status = fp.readlines()
+        fp.close()
+        io = read_proc_io(pid)
+    except OSError:
+        return None
+
+    # Skip past the command name, it can contain spaces. utime and stime are
+    # fields 14 and 15 (man proc), in clock ticks
+    fields = stat[stat.rindex(")") + 2:].split()
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    usage = {"user_time": int(fields[11]) / ticks,
+             "sys_time": int(fields[12]) / ticks, "max_rss_kb": None}
+    for row in status:
+        if row.startswith("VmHWM:"):
+            usage["max_rss_kb"] = int(row.split()[1])
+    for key in ["rchar", "wchar", "read_bytes", "write_bytes"]:
+        usage[key] = io.get(key)
+
+    return usage
+
+def read_proc_io(pid):
+    """
+    Parse /proc/<pid>/io into a dictionary of ints
+    """
+    io = {}
+    fp = open("/proc/%d/io" % (pid), "r")
+    for row in fp:
+        (key, val) = row.split(":")
+        io[key.strip()] = int(val)
+    fp.close()
+
+    return io
 
 def merge_two_dicts(x, y):
     """Given two dicts, merge them into a new dict as a shallow copy."""
@@ -30,7 +30,7 @@ import shutil
 import tempfile
 import optparse
 
-from cable_utils import adjust_nml_file
+from namelist import Namelist
 from cable_utils import generate_spatial_qsub_script
 
 
@@ -144,7 +144,9 @@ class RunCable(object):
                         "cable_user%MetType": "'gswp3'",
                         "verbose": ".FALSE.",
         }
-        adjust_nml_file(self.nml_fname, replace_dict)
+        nml = Namelist(self.nml_fname)
+        nml.update(replace_dict)
+        nml.write(self.nml_fname)
 
     def run_qsub_script(self, start_yr, end_yr):
 
@@ -165,6 +167,20 @@ class RunCable(object):
     def create_new_nml_file(self, log_fname, out_fname, restart_in_fname,
                             restart_out_fname, year, co2_conc):
 
+        replace_dict = self.get_year_replacements(log_fname, out_fname,
+                                                  restart_in_fname,
+                                                  restart_out_fname, year,
+                                                  co2_conc)
+        nml = Namelist(self.nml_fname)
+        nml.update(replace_dict)
+        nml.write(self.nml_fname)
+
+        # save copy as we go for debugging - remove later
+        nml.write(os.path.join(self.namelist_dir, "cable_%d.nml" % (year)))
+
+    def get_year_replacements(self, log_fname, out_fname, restart_in_fname,
+                              restart_out_fname, year, co2_conc):
+
         out_log_fname = os.path.join(self.log_dir, log_fname)
         out_fname = os.path.join(self.output_dir, out_fname)
 
@@ -212,11 +228,8 @@ class RunCable(object):
                         "gswpfile%Tair": "'%s'" % (tair_fn),
                         "gswpfile%wind": "'%s'" % (wind_fn),
         }
-        adjust_nml_file(self.nml_fname, replace_dict)
 
-        # save copy as we go for debugging - remove later
-        shutil.copyfile(self.nml_fname, os.path.join(self.namelist_dir,
-                                                     "cable_%d.nml" % (year)))
+        return replace_dict
 
     def sort_restart_files(self, start_yr, end_yr):
 
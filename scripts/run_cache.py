@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed cache of CABLE site runs.
+
+A run is identified by the bytes of everything that can change its answer:
+the executable, the namelist (minus the output/log paths, which differ
+between runs but not the science), the met file, the LAI input and the
+veg/soil/grid parameter files. If that key has been run before, the cached
+output is copied into the output directory (a reflink where the filesystem
+supports it) instead of running the model. Outputs are cached as the model
+wrote them, each run adds its own provenance to its copy.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import shutil
+import hashlib
+
+from cable_utils import file_hash
+from cable_utils import clone_file
+
+# Namelist keys that only say where things are written/read from, their
+# contents (where relevant) are hashed separately
+PATH_ONLY_KEYS = ["filename%met", "filename%out", "filename%log",
+                  "filename%restart_out"]
+
+class RunCache(object):
+
+    def __init__(self, cache_dir=None):
+
+        self.cache_dir = cache_dir
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def make_key(self, exe_fname, nml_fname, input_fnames, extra="",
+                 path_only=[]):
+        """
+        Build the cache key for a run.
+
+        Parameters:
+        ----------
+        exe_fname : string
+            CABLE executable
+        nml_fname : string
+            rendered namelist file for the run
+        input_fnames : list
+            input files whose contents affect the run (met, LAI, params)
+        extra : string
+            anything else that affects the run, e.g. a fixed LAI value
+        path_only : list
+            more namelist keys to leave out, see PATH_ONLY_KEYS
+
+        Returns:
+        --------
+        key : string
+            hex digest
+        """
+        h = hashlib.sha256()
+        h.update(file_hash(exe_fname).encode())
+
+        fp = open(nml_fname, "r")
+        namelist = fp.readlines()
+        fp.close()
+        for row in namelist:
+            key = row.split("=")[0].strip().lower()
+            if key not in PATH_ONLY_KEYS and key not in path_only:
+                h.update(row.strip().encode())
+
+        for fname in input_fnames:
+            h.update(file_hash(fname).encode())
+        h.update(str(extra).encode())
+
+        return h.hexdigest()
+
+    def fetch(self, key, out_fname, out_log_fname):
+        """
+        Put a cached run in place, returns False on a cache miss. The output
+        is a copy of its own, ready for the run's provenance to be added.
+        """
+        cached_out = self.cached_fname(key, "out.nc")
+        if not os.path.isfile(cached_out):
+            return False
+
+        tmp_fname = "%s.%d.tmp" % (out_fname, os.getpid())
+        clone_file(cached_out, tmp_fname)
+        os.replace(tmp_fname, out_fname)
+
+        # Logs are never changed once written, so can share the cache's
+        cached_log = self.cached_fname(key, "log.txt")
+        if os.path.isfile(cached_log):
+            link_or_copy(cached_log, out_log_fname)
+
+        return True
+
+    def store(self, key, out_fname, out_log_fname):
+        """
+        Add a finished run to the cache, before its provenance is added to
+        the output. The output is cached as a copy of its own, as the run's
+        is about to be written to.
+        """
+        for (fname, suffix) in [(out_log_fname, "log.txt"),
+                                (out_fname, "out.nc")]:
+            if not os.path.isfile(fname):
+                continue
+
+            # Copy under a temporary name then rename, so a half-written
+            # entry is never visible to other workers
+            cached = self.cached_fname(key, suffix)
+            tmp_fname = "%s.%d.tmp" % (cached, os.getpid())
+            if suffix == "out.nc":
+                clone_file(fname, tmp_fname)
+            else:
+                link_or_copy(fname, tmp_fname)
+            os.replace(tmp_fname, cached)
+
+    def cached_fname(self, key, suffix):
+        return os.path.join(self.cache_dir, "%s_%s" % (key, suffix))
+
+def link_or_copy(src, dst):
+    """
+    Hard link src to dst, falling back to a copy across filesystems. The
+    link is made under a temporary name and renamed over dst, so a dst left
+    behind by an interrupted run is simply replaced.
+    """
+    tmp_fname = "%s.%d.link" % (dst, os.getpid())
+    if os.path.lexists(tmp_fname):
+        os.remove(tmp_fname)
+    try:
+        os.link(src, tmp_fname)
+    except OSError:
+        shutil.copyfile(src, tmp_fname)
+    os.replace(tmp_fname, dst)
+
+    # Renaming onto another link to the same file does nothing
+    if os.path.lexists(tmp_fname):
+        os.remove(tmp_fname)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Work queue on a shared filesystem, so several independently queued PBS jobs
+can cooperate on one site campaign with no server, just the run directory
+they all see.
+
+A task is claimed by creating a claim file with O_CREAT | O_EXCL, which
+only one job can ever win. The job holding a claim touches it every so
+often; a claim that hasn't been touched for `lease` seconds belongs to a
+job that has died, and is taken over by renaming it out of the way first
+(rename is atomic, so again only one job wins). Finished tasks are read
+from the campaign Ledger.
+
+That's all folks.
+"""
+__version__ = "1.0 (18.10.2026)"
+
+import os
+import time
+import socket
+import shutil
+import hashlib
+
+from campaign import task_key
+
+class WorkQueue(object):
+
+    def __init__(self, queue_dir=None, ledger=None, lease=600.):
+
+        self.queue_dir = queue_dir
+        self.ledger = ledger
+        self.lease = lease
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+        if not os.path.exists(self.queue_dir):
+            os.makedirs(self.queue_dir)
+
+        # Attempts recorded in the ledger when we planned our tasks, any
+        # more than this and another job has dealt with the task since
+        self.attempts = dict(self.ledger.attempts())
+        self.claimed = set()
+
+    def claim(self, task):
+        """
+        Try and claim a task, returns False if another job has it or has
+        already run it.
+        """
+        key = task_key(task)
+        if self.ledger.attempts().get(key, 0) > self.attempts.get(key, 0):
+            return False
+
+        claim_fname = self.claim_fname(task)
+        if not self.create_claim(claim_fname):
+            if not self.expired(claim_fname):
+                return False
+
+            # Previous owner has died, take it over. Only one job can win
+            # the rename, the others see the claim vanish and give up
+            stale_fname = "%s.stale.%s" % (claim_fname, self.owner)
+            try:
+                os.rename(claim_fname, stale_fname)
+            except OSError:
+                return False
+            os.remove(stale_fname)
+            if not self.create_claim(claim_fname):
+                return False
+
+        # Check again now we hold it, the task may have finished between
+        # reading the ledger and the previous owner releasing the claim
+        if self.ledger.attempts().get(key, 0) > self.attempts.get(key, 0):
+            self.release(task)
+            return False
+
+        self.claimed.add(claim_fname)
+
+        return True
+
+    def renew(self):
+        """
+        Heartbeat, touch all our claims so they don't expire.
+        """
+        for claim_fname in list(self.claimed):
+            try:
+                os.utime(claim_fname, None)
+            except OSError:
+                self.claimed.discard(claim_fname)
+
+    def release(self, task):
+        claim_fname = self.claim_fname(task)
+        self.claimed.discard(claim_fname)
+        try:
+            os.remove(claim_fname)
+        except OSError:
+            pass
+
+    def reset(self):
+        """
+        Clear out the claims for a fresh campaign.
+        """
+        shutil.rmtree(self.queue_dir, ignore_errors=True)
+        os.makedirs(self.queue_dir)
+        self.attempts = dict(self.ledger.attempts())
+        self.claimed = set()
+
+    def claim_fname(self, task):
+        key = hashlib.sha1(task_key(task).encode()).hexdigest()
+
+        return os.path.join(self.queue_dir, "%s.claim" % (key))
+
+    def create_claim(self, claim_fname):
+        try:
+            fd = os.open(claim_fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o644)
+        except FileExistsError:
+            return False
+        os.write(fd, self.owner.encode())
+        os.close(fd)
+
+        return True
+
+    def expired(self, claim_fname):
+        try:
+            age = time.time() - os.path.getmtime(claim_fname)
+        except OSError:
+            return False
+
+        return age > self.lease
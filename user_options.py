@@ -24,6 +24,12 @@ mem = "32GB"
 wall_time = "01:30:00"
 email_address = "mdekauwe@gmail.com"
 
+# Split the campaign over a PBS job array of nslices elements, each with
+# ncpus and with mem/wall_time sized from the met files in its slice (the
+# mem and wall_time above are then ignored). 1 submits a single job
+nslices = 1
+secs_per_step = 0.002 # CABLE cost per met timestep, until we've timed runs
+
 #
 ## Repositories to test, default is head of the trunk against personal repo.
 ## But if trunk is false, repo1 could be anything
@@ -50,6 +56,20 @@ plot_dir = "plots"
 output_dir = "outputs"
 restart_dir = "restart_files"
 namelist_dir = "namelists"
+cache_dir = "run_cache" # previous runs, set to None to always rerun
+lai_cache_dir = "lai_cache" # met files with LAI added, shared between runs
+lai_cache_gb = 50 # least recently used met files go beyond this, None = no limit
+ledger_fname = "campaign_ledger.jsonl" # finished runs, lives in run_dir
+queue_dir = "work_queue" # claims, so several qsub jobs can share a campaign
+met_catalog_fname = "met_catalog.json" # what is in each met file, in run_dir
+reduction_cache_dir = "reductions" # outputs' seasonal cycles etc, None = reread
+metrics_fname = "benchmark_metrics.csv" # old vs new run metrics, in plot_dir
+
+# Run each site in its own directory on node-local disk (e.g. PBS jobfs or
+# /dev/shm) and copy the outputs back, keeps the run files off /g/data.
+# None runs everything in run_dir
+scratch_dir = os.environ.get("PBS_JOBFS")
+jobfs = "100GB"
 
 if not os.path.exists(src_dir):
     os.makedirs(src_dir)
@@ -120,5 +140,19 @@ sci_configs = [sci1, sci2]
 #
 mpi = True
 num_cores = ncpus # set to a number, if None it will use all cores...!
+engine = "pool" # "pool" of python workers or "asyncio" event loop
+
+# Spin up each site (repo, sci_config) first, cycling the met data until the
+# carbon pools are in equilibrium, and start the runs from there. Sites are
+# spun up in parallel and each stops as soon as it has equilibrated
+spin_up = False
+nyear_spinup = 30 # years of met per spin-up cycle
+max_spin_cycles = 20
+
+# Kill hung runs: those taking timeout_factor times longer than expected
+# from past runs, or whose output hasn't grown for stall_time seconds.
+# None switches either off
+timeout_factor = 5.0
+stall_time = 1800.
 
 # ----------------------------------------------------------------------- #